@@ -1,6 +1,7 @@
 from numeric_sim import N_simulation as nSim
 from numeric_sim import C_profiles as cProf
 from numeric_sim import Impurity
+from numeric_cache import SimulationCache
 
 import matplotlib
 matplotlib.use('QtAgg')
@@ -10,7 +11,7 @@ from matplotlib.figure import Figure
 import numpy as np
 
 from PyQt6.QtGui import QValidator
-from PyQt6.QtCore import QSize, Qt
+from PyQt6.QtCore import QSize, Qt, QObject, QThread, pyqtSignal
 from PyQt6.QtWidgets import (
     QComboBox,
     QSpinBox,
@@ -51,12 +52,66 @@ class ScientificDoubleSpinBox(QDoubleSpinBox):
             return (QValidator.State.Invalid, text, pos)
         
 
+class SimulationWorker(QObject):
+    """
+        Runs the predep./drive-in pipeline off the GUI thread.\n
+        Progress, status and results are sent back to the window through Qt signals.
+    """
+    progress = pyqtSignal(int)                      # Progress percentage of the running stage
+    status   = pyqtSignal(str)                      # Progress label text
+    junction = pyqtSignal(int, float)               # (stage, junction depth in cm) - 1: predep., 2: drive-in
+    finished = pyqtSignal(object)                   # Result dictionary, None if the simulation is terminated
+
+    def __init__(self, param:dict, engine:str="vector", accuracy:float=1e-4, cache:SimulationCache=None, dtype=np.float64):
+        super().__init__()
+        self.param    = param
+        self.engine   = engine
+        self.accuracy = accuracy
+        self.cache    = cache
+        self.stage    = ""
+
+        # Simulations are created here (GUI thread), so they can be terminated before the worker starts running
+        self.preDep  = nSim(param["Dopant"], param["T0"], dtype=dtype)
+        self.driveIn = nSim(param["Dopant"], param["T1"], dtype=dtype)
+
+    def updateRate(self, rate:float, eta:float):    # Show steps/second and ETA next to the running stage
+        self.status.emit("{} {:.0f} steps/s, ETA {:.0f} s".format(self.stage, rate, eta))
+
+    def run(self):                                  # Run the simulation
+        Cb, Cth, xD, t0, t1 = (self.param[key] for key in ("Cb", "Cth", "xL", "t0", "t1"))
+        outputs = {"progressPercentageOutput": self.progress.emit, "progressOutput": self.status.emit, "progressRateOutput": self.updateRate}
+
+        # Run the simulation for predep. - loaded from the cache if only the drive-in parameters are changed
+        self.stage = "Running Simulation: 1/2..."
+        self.status.emit(self.stage)
+        Cp_1, xjunc_1 = self.preDep.predeposition(xD, t0, Cb, Cth, self.engine, self.accuracy, self.cache, **outputs)
+        if self.preDep.terminateFlag:
+            self.finished.emit(None)
+            return
+        self.junction.emit(1, xjunc_1)
+
+        # Run the simulation for drive-in, starting from the predep. profile
+        self.stage = "Running Simulation: 2/2..."
+        self.status.emit(self.stage)
+        Cp_2, xjunc_2 = self.driveIn.drive_in(Cp_1, t1, Cb, Cth, self.engine, self.accuracy, self.cache, **outputs)
+        if self.driveIn.terminateFlag:
+            self.finished.emit(None)
+            return
+        self.junction.emit(2, xjunc_2)
+
+        self.finished.emit({"Cp_1": Cp_1, "Cp_2": Cp_2, "xjunc_1": xjunc_1, "xjunc_2": xjunc_2, "x_step": self.preDep.x_step, "Cth": Cth})
+
+    def terminate(self):                            # Thread-safe, engines stop at their next time step
+        self.preDep.terminate()
+        self.driveIn.terminate()
+
+
 class MainWindow(QMainWindow):
     def __init__(self):                                 # Initialize the main window
         super().__init__()
 
         # Define default parameters
-        global _Cb_default, _Cth_default, _Dopant_default, _T0_default, _T1_default, _xL_default, _xL_unit_default, _t0_default, _t1_default, _prgrss_default, _prgrss_lgnd_default, _prgrss_val_default, _xJun1_default, _xJun2_default
+        global _Cb_default, _Cth_default, _Dopant_default, _T0_default, _T1_default, _xL_default, _xL_unit_default, _t0_default, _t1_default, _prgrss_default, _prgrss_lgnd_default, _prgrss_val_default, _xJun1_default, _xJun2_default, _Solver_default, _accuracy_default, _cache_dir_default, _compact_default
         _Cb_default          = 0     # in atoms/cm^3
         _Cth_default         = 1e15  # in atoms/cm^3
         _Dopant_default      = 2     # Boron
@@ -71,6 +126,13 @@ class MainWindow(QMainWindow):
         _prgrss_val_default  = "..."
         _xJun1_default       = "..."
         _xJun2_default       = "..."
+        _Solver_default      = 0     # 0: Explicit, 1: Implicit, 2: Adaptive
+        _accuracy_default    = 1e-4  # Relative time discretization error for the implicit solver, tolerance for the adaptive one
+        _cache_dir_default   = None  # Directory for the on-disk result cache, None: memory only
+        _compact_default     = False # True: float32 profiles, half the memory of float64
+
+        # Completed runs are kept, so re-running the same recipe is instant
+        self.cache = SimulationCache(directory=_cache_dir_default)
 
         # Create a container widget
         widget = QWidget()
@@ -202,6 +264,13 @@ class MainWindow(QMainWindow):
         self.t1.setValue(_t1_default)
         # print(t1)
 
+        Solver_label = QLabel("Select solver: ")
+        self.Solver_in = QComboBox()
+        self.Solver_in.addItem("Explicit (FTCS)")
+        self.Solver_in.addItem("Implicit (Crank-Nicolson)")
+        self.Solver_in.addItem("Adaptive (error control)")
+        self.Solver_in.setCurrentIndex(_Solver_default)
+
         # Clear button
         Clear = QPushButton("Reset!")
 
@@ -284,13 +353,16 @@ class MainWindow(QMainWindow):
         layout.addWidget(helpB,                 1, 9, 1, 2)
         layout.addWidget(exitB,                 2, 9, 2, 2)
 
-        layout.addWidget(linearPlotCanvasTitle, 4, 0, 1, 5)
-        layout.addWidget(self.linearPlotCanvas, 5, 0, 1, 5)
-        layout.addWidget(self.linPC_tb,         6, 0, 1, 5)
+        layout.addWidget(Solver_label,          4, 0, 1, 1)
+        layout.addWidget(self.Solver_in,        4, 1, 1, 2)
 
-        layout.addWidget(logPlotCanvasTitle,    4, 5, 1, 6)
-        layout.addWidget(self.logPlotCanvas,    5, 5, 1, 6)
-        layout.addWidget(self.logPC_tb,         6, 5, 1, 6)
+        layout.addWidget(linearPlotCanvasTitle, 5, 0, 1, 5)
+        layout.addWidget(self.linearPlotCanvas, 6, 0, 1, 5)
+        layout.addWidget(self.linPC_tb,         7, 0, 1, 5)
+
+        layout.addWidget(logPlotCanvasTitle,    5, 5, 1, 6)
+        layout.addWidget(self.logPlotCanvas,    6, 5, 1, 6)
+        layout.addWidget(self.logPC_tb,         7, 5, 1, 6)
 
         # Create the menu bar
         # self._createMenuBar(layout)
@@ -313,14 +385,11 @@ class MainWindow(QMainWindow):
         else:
             return xL*1e4         # convert cm to µm
 
-    def plot(self, Cp_1:cProf, Cp_2:cProf, Cth_profile:cProf, x_ax:list, xJunc_1:float, xJunc_2:float): # Plot the results
+    def plot(self, Cp_1:cProf, Cp_2:cProf, Cth:float, x_ax:list, xJunc_1:float, xJunc_2:float): # Plot the results
         # Clear the previous plot (if any)
         self.figure_lin.clear()
         self.figure_log.clear()
 
-        # Get Cth from the Cth_profile
-        Cth = Cth_profile.arr[0]
-
         # Convert the junction depths to specified unit
         xJunc_1_inUnit = self.xL_unitConverter_inv(xJunc_1)
         xJunc_2_inUnit = self.xL_unitConverter_inv(xJunc_2)
@@ -334,7 +403,7 @@ class MainWindow(QMainWindow):
         ax1.set_ylabel('Concentration (atoms/cm^3)')
         ax1.plot(x_ax, Cp_1.arr, color='C0', label='Predep.',  zorder=1)
         ax1.plot(x_ax, Cp_2.arr, color='C1', label='Drive-in', zorder=0)
-        ax1.plot(x_ax, Cth_profile.arr, color='C2', label='Background Conc.', linestyle='dashed', zorder=2)
+        ax1.axhline(Cth, color='C2', label='Background Conc.', linestyle='dashed', zorder=2)
         ax1.legend(loc='upper right', prop={'size': 6})                             # Set the legend location
         
         # Set the progress bar: 60% complete
@@ -347,7 +416,7 @@ class MainWindow(QMainWindow):
         ax2.set_ylabel('Concentration (atoms/cm^3)')
         ax2.plot(x_ax, Cp_1.arr, color='C0', label='Predep.',  zorder=1)
         ax2.plot(x_ax, Cp_2.arr, color='C1', label='Drive-in', zorder=0)
-        ax2.plot(x_ax, Cth_profile.arr, color='C2', label='Background Conc.', linestyle='dashed', zorder=2)
+        ax2.axhline(Cth, color='C2', label='Background Conc.', linestyle='dashed', zorder=2)
         ax2.scatter(xJunc_1_inUnit, Cth, color='brown', marker='o', label='Junction Depth for Predep.',  zorder=3)
         ax2.scatter(xJunc_2_inUnit, Cth, color='black', marker='o', label='Junction Depth for Drive-in', zorder=3)
         ax2.legend(loc='upper right', prop={'size': 6})                             # Set the legend location
@@ -394,6 +463,19 @@ class MainWindow(QMainWindow):
         self.progress_val.setText("{}{}".format(value, unit))
         QApplication.processEvents()  # Process all pending events
 
+    def showProgress(self, value:int):                  # Update the progress bar from the worker (no event processing)
+        self.progress.setValue(value)
+        self.progress_val.setText("{}%".format(value))
+
+    def showProgressLabel(self, text:str):              # Update the progress label from the worker (no event processing)
+        self.progress_label.setText(text)
+
+    def showJuncDepth(self, stage:int, val:float):      # Update the junction depth of the finished stage
+        if stage == 1:
+            self.updateJuncDepth(self.xJunc_1, val, self.xJunc_unit1)
+        else:
+            self.updateJuncDepth(self.xJunc_2, val, self.xJunc_unit2)
+
     def updateParameters(self):                         # Update input parameters
         self.updateDopantProfile(self.Dopant_in.currentIndex())
         self.xL = self.xL_unitConverter(self.xL_inUnit.value())
@@ -429,6 +511,7 @@ class MainWindow(QMainWindow):
         self.xL_inUnit.setValue(_xL_default)
         self.t0.setValue(_t0_default)
         self.t1.setValue(_t1_default)
+        self.Solver_in.setCurrentIndex(_Solver_default)
         self.resetProgress()
     
     def resetProgress(self):                            # Reset the progress bar
@@ -475,18 +558,13 @@ class MainWindow(QMainWindow):
             self.startSimulation.setText("Terminate!")
             self.startSimulation.setStyleSheet("color: #DC143C")
             self.simulate()
-            self.startSimulation.setText("Simulate!")
-            self.startSimulation.setStyleSheet("color: #FFD700")
         else:
             self.startSimulation.setText("Terminating...")
             self.startSimulation.setStyleSheet("color: #800000")
             self.startSimulation.setEnabled(False)
             self.terminate_simulation()
-            self.startSimulation.setText("Simulate!")
-            self.startSimulation.setStyleSheet("color: #FFD700")
-            self.startSimulation.setEnabled(True)
 
-    def simulate(self):                                 # Run the simulation
+    def simulate(self):                                 # Start the simulation on a worker thread
         self.clearCanvas()
         self.resetJuncDepth()
         self.resetProgress()
@@ -494,96 +572,68 @@ class MainWindow(QMainWindow):
 
         # Set initial parameters
         param =  self.updateParameters()
-        Cb, Cth, Dopant, T0, T1, xD, t0, t1 = self.kwargParser(**param)
-
-        # Create instances of the N_simulation class
-        self.preDep  = nSim(Dopant, T0)
-        self.driveIn = nSim(Dopant, T1)
-
-        # Set the progress bar: 33% complete
-        self.updateProgress(33)
 
-        # Set the simulation parameters
-        x_i  = int(xD/self.preDep.x_step)+1    #x_step is set to either 1e-8 cm (1 Angstrom) or 1e-7 (1 nm) inside nSim - constant for both simulations
-        t_j0 = int(t0/self.preDep.t_step)+1    #Number of time iterations for predep.
-        t_j1 = int(t1/self.driveIn.t_step)+1   #Number of time iterations for drive-in
-        # print("# of iterations for predep.: ", t_j0, "\n# of iterations for drive-in: ", t_j1)
-        
-        # Set the progress bar: 66% complete
-        self.updateProgress(66)
+        # Select the engine
+        engine = ("vector", "implicit", "adaptive")[self.Solver_in.currentIndex()]
 
-        # Create an instance of the C_profiles class
-        C_1 = cProf(x_i=x_i, Cb=Cb)
-        C_2 = cProf(x_i=x_i, Cb=Cb)
-        Cth_profile = cProf().create_empty_profile(x_i=x_i, Cb=Cth)
-        
-        # Set the progress bar: 100% complete
-        self.updateProgress(100)
-        self.updateProgressLabel("Done!")
+        # Create the worker and move it to its own thread
+        self.simThread = QThread()
+        self.simWorker = SimulationWorker(param, engine, _accuracy_default, self.cache, np.float32 if _compact_default else np.float64)
+        self.simWorker.moveToThread(self.simThread)
 
-        # Set the progress bar: 0% complete
-        self.updateProgress(0)
-        self.updateProgressLabel("Running Simulation: 1/2...")
-
-        # Run the simulation for predep.
-        Cp_1, xjunc_1 = self.preDep.lumerical_on_budget(C_1, Cb, Cth, t_j=t_j0, 
-                                                        progressPercentageOutput=self.updateProgress, 
-                                                        progressOutput=self.updateProgressLabel,
-                                                        )
-        self.updateProgressLabel("Predep. sim. is completed. Saving profile...")
-        
-        # Print the junction depths:
-        self.updateJuncDepth(self.xJunc_1, xjunc_1, self.xJunc_unit1)
+        # Connect the signals
+        self.simThread.started.connect(self.simWorker.run)
+        self.simWorker.progress.connect(self.showProgress)
+        self.simWorker.status.connect(self.showProgressLabel)
+        self.simWorker.junction.connect(self.showJuncDepth)
+        self.simWorker.finished.connect(self.simThread.quit)
+        self.simWorker.finished.connect(self.simulation_finished)
 
-        # Set the progress bar: 0% complete
-        self.updateProgress(0)
-        self.updateProgressLabel("Running Simulation: 2/2...")
+        # Run
+        self.simThread.start()
 
-        # Set the initial profile for the next simulation
-        C_2.Cold = Cp_1                   
+    def simulation_finished(self, result):              # Plot the results of the worker (GUI thread)
+        self.simThread.wait()
 
-        # Run the simulation for drive-in
-        Cp_2, xjunc_2 = self.driveIn.lumerical_on_budget(C_2, Cb, Cth, t_j=t_j1,
-                                                         process=1, 
-                                                         progressPercentageOutput=self.updateProgress, 
-                                                         progressOutput=self.updateProgressLabel,
-                                                         )
-        self.updateProgressLabel("Drive-in simulation completed. Saving profile...")
-
-        # Print the junction depths:
-        self.updateJuncDepth(self.xJunc_2, xjunc_2, self.xJunc_unit2)
+        if result is None:
+            self.resetProgress()
+            self.updateProgressLabel("Simulation is terminated.")
+        else:
+            self.updateProgressLabel("Plotting the profiles...")
+            self.updateProgress(0)
 
-        # Set the progress bar: 0% complete
-        self.updateProgress(0)
-        self.updateProgressLabel("Plotting the profiles...")
+            # Cut the first element of the profile to avoid the initial condition
+            Cp_1, Cp_2 = result["Cp_1"], result["Cp_2"]
+            Cp_1.cut_initial()
+            Cp_2.cut_initial()
 
-        # Cut the first element of the profile to avoid the initial condition
-        Cp_1.cut_initial()
-        Cp_2.cut_initial()
-        Cth_profile.cut_initial()
+            # Construct the x-axis array
+            x_step_inUnit = self.xL_unitConverter_inv(result["x_step"])  # Convert the x_step to the specified unit
+            x_ax = np.arange(Cp_1.size())*x_step_inUnit                   # Construct the x-axis array in specified unit
 
-        # Construct the x-axis array
-        x_step_inUnit = self.xL_unitConverter_inv(self.preDep.x_step) # Convert the x_step to the specified unit
-        range_arr = np.array(range(Cth_profile.size()))
-        x_ax = range_arr*x_step_inUnit                                # Construct the x-axis array in specified unit
+            # Set the progress bar: 10% complete
+            self.updateProgress(20)
 
-        # Set the progress bar: 10% complete
-        self.updateProgress(20)
+            # Plot the results
+            self.plot(Cp_1, Cp_2, result["Cth"], x_ax, result["xjunc_1"], result["xjunc_2"])
 
-        # Plot the results
-        self.plot(Cp_1, Cp_2, Cth_profile, x_ax, xjunc_1, xjunc_2)
+            # Set the progress bar: 100% complete
+            self.updateProgress(100)
+            self.updateProgressLabel("Done!")
 
-        # Set the progress bar: 100% complete
-        self.updateProgress(100)
-        self.updateProgressLabel("Done!")
+        # Reset the button
+        self.startSimulation.setText("Simulate!")
+        self.startSimulation.setStyleSheet("color: #FFD700")
+        self.startSimulation.setEnabled(True)
 
-        # # Clear the junk
-        # del self.preDep, self.driveIn
-        # del C_1, C_2, Cp_1, Cp_2, Cth_profile
+    def terminate_simulation(self):                     # Terminate the simulation
+        self.simWorker.terminate()
 
-    def terminate_simulation(self):                     # Terminate the simulation - Not working properly
-        self.preDep.terminate()
-        self.driveIn.terminate()
+    def closeEvent(self, event):                        # Stop a running simulation before closing
+        if getattr(self, "simThread", None) is not None and self.simThread.isRunning():
+            self.simWorker.terminate()
+            self.simThread.wait()
+        super().closeEvent(event)
     
     def show_popup(self, dialog_text:str="You've found me!", dialog_title:str="Easter Egg"): # Show a popup window
         msg = QMessageBox()
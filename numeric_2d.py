@@ -0,0 +1,232 @@
+import numpy as np
+
+from numeric_sim import N_simulation, ProgressReporter, solve_tridiagonal, junction_depth
+
+
+def _tridiagonal(n:int=1, r:float=0) -> tuple:
+    """
+        _tridiagonal(n=1, r=0)
+
+    Returns the (lower, main, upper) diagonals of I - r*L for n points, with no flux (mirror point) at both ends.
+    """
+    a = np.full(n, -r)
+    b = np.full(n, 1 + 2*r)
+    c = np.full(n, -r)
+    c[0]  = -2*r
+    a[-1] = -2*r
+    return a, b, c
+
+
+class N_simulation2D: # 2-D simulation (depth x lateral)
+    """
+        This class simulates diffusion in a cross section of the wafer: depth (axis 0) x lateral position (axis 1).\n
+        Predep. keeps the surface at C0 only inside the mask window, the surface under the mask has no flux.\n
+        Lateral edges have no flux (symmetry planes), the bottom is kept at Cb.\n
+        Time steps use the Peaceman-Rachford alternating direction implicit scheme: every half step solves\n
+        tridiagonal systems along all columns, then along all rows, at once. The first two steps are locally\n
+        one dimensional backward Euler steps, which damp the discontinuity at the window edges.
+    """
+    def __init__(self, dopant=None, T:float=900, x_step:float=None, y_step:float=None, verbose:bool=True):
+        """
+        Parameters:
+        --------------------------------
+        dopant   -   Dopant of the simulation                        : Impurity
+        T        -   Temperature for process (degree C)              : float
+        x_step   -   Position step in depth (cm)                     : float
+        y_step   -   Position step in lateral direction (cm)         : float
+        """
+        self.sim = N_simulation(dopant, T, verbose=False)  # Impurity parameters, diffusivity and termination
+        self.C0 = self.sim.C0
+        self.x_step = x_step or self.sim.x_step
+        self.y_step = y_step or self.x_step
+        if verbose:
+            print("Position steps: ", self.x_step, self.y_step)
+
+    @property
+    def D(self) -> float:
+        return self.sim.D
+
+    def set_temperature(self, T:float=900):
+        self.sim.set_temperature(T)
+
+    def create_profile(self, xL:float=6e-5, yL:float=6e-5, Cb:float=0) -> np.array:
+        """
+            create_profile(xL=6e-5, yL=6e-5, Cb=0)
+
+        Returns a (depth x lateral) profile filled with Cb for a cross section of xL by yL.
+        """
+        return np.full((int(xL/self.x_step)+1, int(yL/self.y_step)+1), float(Cb))
+
+    def window_mask(self, ny:int=1, window:tuple=None) -> np.array:
+        """
+            window_mask(ny=1, window=None)
+
+        Returns the surface points inside the mask window (y_start, y_end) in cm, all points if window is None.
+        """
+        if window is None:
+            return np.ones(ny, dtype=bool)
+        y = np.arange(ny)*self.y_step
+        return (y >= window[0] - 1e-3*self.y_step) & (y <= window[1] + 1e-3*self.y_step)
+
+    def lumerical_on_budget(self, C:np.array, Cb:float=0, Cth:float=1e15, t:float=0, process:bool=0, window:tuple=None, accuracy:float=1e-4, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> tuple:
+        """
+            lumerical_on_budget(C, Cb=0, Cth=1e15, t=0, process=0, window=None, accuracy=1e-4, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Diffuses the (depth x lateral) profile C for t seconds. Returns (C, xjunc, yjunc), see junctions.\n
+        The time step is set from the accuracy (see N_simulation.implicit_time_step) and lands exactly on t.
+
+        Parameters:
+        --------------------------------
+        C         -   Profile (depth x lateral) (atoms/cm^3)          : np.array (2D)
+        Cb        -   Bottom concentration clip (atoms/cm^3)          : float
+        Cth       -   Threshold (backgrnd) concentration (atoms/cm^3) : float
+        t         -   Process time (seconds)                          : float
+        process   -   Selected process (predep./drive-in)             : bool
+        window    -   Mask window (y_start, y_end) (cm)               : tuple
+        accuracy  -   Target relative error                           : float
+        """
+        C = np.array(C, dtype=float)
+        nx, ny = C.shape
+        inside = self.window_mask(ny, window)
+        fixed = inside if process == 0 else np.zeros(ny, dtype=bool)   # Surface points kept at C0
+
+        C[-1, :] = Cb                       #set initial condition and boundary condition
+        C[0, fixed] = self.C0
+
+        if t > 0:
+            t_step = self.sim.implicit_time_step(t, accuracy)
+            t_j = max(int(round(t/t_step)), 1)
+            t_step = t/t_j
+            rx = self.D*t_step/(2*self.x_step**2)
+            ry = self.D*t_step/(2*self.y_step**2)
+
+            progress = ProgressReporter(t_j+1, progressPercentageOutput, progressRateOutput, lambda: self.terminateFlag, self.sim.progressInterval)
+            for j in range(1, t_j+1):
+                if progress.update(j):
+                    progressOutput("Simulation is terminated.")
+                    break
+                if j <= 2:
+                    C = self._solve_x(C, 2*rx, C, Cb, fixed)
+                    C = self._solve_y(C, 2*ry, C, fixed)
+                else:
+                    C = self._solve_x(C, rx, C + ry*self._lateral(C, fixed), Cb, fixed)
+                    C = self._solve_y(C, ry, C + rx*self._vertical(C, fixed), fixed)
+
+        xjunc, yjunc = self.junctions(C, Cth, inside)
+        return C, xjunc, yjunc
+
+    def _vertical(self, C:np.array, fixed:np.array) -> np.array:
+        """
+            _vertical(C, fixed)
+
+        Second difference in depth (without 1/x_step^2), zero at the fixed points and the bottom.
+        """
+        L = np.empty_like(C)
+        L[1:-1] = C[2:] - 2*C[1:-1] + C[:-2]
+        L[0]  = 2*(C[1] - C[0])             # Mirror point at the surface: no flux
+        L[0, fixed] = 0
+        L[-1] = 0
+        return L
+
+    def _lateral(self, C:np.array, fixed:np.array) -> np.array:
+        """
+            _lateral(C, fixed)
+
+        Second difference in lateral direction (without 1/y_step^2), zero at the fixed points and the bottom.
+        """
+        L = np.empty_like(C)
+        L[:, 1:-1] = C[:, 2:] - 2*C[:, 1:-1] + C[:, :-2]
+        L[:, 0]  = 2*(C[:, 1] - C[:, 0])    # Mirror points at the lateral edges: no flux
+        L[:, -1] = 2*(C[:, -2] - C[:, -1])
+        L[0, fixed] = 0
+        L[-1] = 0
+        return L
+
+    def _solve_x(self, C:np.array, r:float, rhs:np.array, Cb:float, fixed:np.array) -> np.array:
+        """
+            _solve_x(C, r, rhs, Cb, fixed)
+
+        Solves (I - r*Lx) Cnew = rhs along every column. Columns with a fixed surface point and free columns\n
+        are two batches of systems with shared coefficients.
+        """
+        Cnew = np.empty_like(C)
+        Cnew[-1] = C[-1]
+        a, b, c = _tridiagonal(C.shape[0]-1, r)
+        a[-1] = -r                          # Last unknown point is next to the bottom (Cb)
+        d = rhs[:-1].copy()
+        d[-1] += r*Cb
+        free = ~fixed
+        if free.any():
+            Cnew[:-1, free] = solve_tridiagonal(a, b, c, d[:, free].T).T
+        if fixed.any():
+            b, c = b.copy(), c.copy()
+            b[0], c[0] = 1, 0               # Surface point is kept at C0
+            d[0, fixed] = self.C0
+            Cnew[:-1, fixed] = solve_tridiagonal(a, b, c, d[:, fixed].T).T
+        return Cnew
+
+    def _solve_y(self, C:np.array, r:float, rhs:np.array, fixed:np.array) -> np.array:
+        """
+            _solve_y(C, r, rhs, fixed)
+
+        Solves (I - r*Ly) Cnew = rhs along every row but the bottom one. The surface row has its own system\n
+        if it has fixed points, all other rows share the coefficients.
+        """
+        Cnew = np.empty_like(C)
+        Cnew[-1] = C[-1]
+        a, b, c = _tridiagonal(C.shape[1], r)
+        Cnew[1:-1] = solve_tridiagonal(a, b, c, rhs[1:-1])
+        if fixed.any():
+            a, b, c = a.copy(), b.copy(), c.copy()
+            a[fixed], b[fixed], c[fixed] = 0, 1, 0
+            d = rhs[0].copy()
+            d[fixed] = self.C0
+            Cnew[0] = solve_tridiagonal(a, b, c, d)
+        else:
+            Cnew[0] = solve_tridiagonal(a, b, c, rhs[0])
+        return Cnew
+
+    def junctions(self, C:np.array, Cth:float=1e15, inside:np.array=None) -> tuple:
+        """
+            junctions(C, Cth=1e15, inside=None)
+
+        Returns (xjunc, yjunc): vertical junction depth under the middle of the window and lateral junction,\n
+        the distance from the window edge to Cth along the surface under the mask (0 if the window has no edge).
+        """
+        if inside is None or not inside.any():
+            inside = np.ones(C.shape[1], dtype=bool)
+        k = np.flatnonzero(inside)
+        xjunc = junction_depth(C[:, k[(k.size-1)//2]], Cth, self.x_step)
+        if k[-1] < C.shape[1]-1:                # Right edge of the window
+            yjunc = junction_depth(C[0, k[-1]:], Cth, self.y_step)
+        elif k[0] > 0:                          # Left edge of the window
+            yjunc = junction_depth(C[0, k[0]::-1], Cth, self.y_step)
+        else:
+            yjunc = 0
+        return xjunc, yjunc
+
+    def predeposition(self, xL:float=6e-5, yL:float=6e-5, t0:float=0, window:tuple=None, Cb:float=0, Cth:float=1e15, accuracy:float=1e-4, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> tuple:
+        """
+            predeposition(xL=6e-5, yL=6e-5, t0=0, window=None, Cb=0, Cth=1e15, accuracy=1e-4, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Predep. of t0 seconds through the mask window on a cross section of xL by yL filled with Cb.\n
+        Returns (Cp_1, xjunc_1, yjunc_1).
+        """
+        C = self.create_profile(xL, yL, Cb)
+        return self.lumerical_on_budget(C, Cb, Cth, t0, 0, window, accuracy, progressPercentageOutput, progressOutput, progressRateOutput)
+
+    def drive_in(self, Cp_1:np.array=None, t1:float=0, window:tuple=None, Cb:float=0, Cth:float=1e15, accuracy:float=1e-4, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> tuple:
+        """
+            drive_in(Cp_1, t1=0, window=None, Cb=0, Cth=1e15, accuracy=1e-4, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Drive-in of t1 seconds starting from a predep. profile, the whole surface has no flux.\n
+        The window is only used to place the junctions. Returns (Cp_2, xjunc_2, yjunc_2), Cp_1 is not modified.
+        """
+        return self.lumerical_on_budget(Cp_1, Cb, Cth, t1, 1, window, accuracy, progressPercentageOutput, progressOutput, progressRateOutput)
+
+    @property
+    def terminateFlag(self) -> bool:
+        return self.sim.terminateFlag
+
+    def terminate(self):
+        self.sim.terminate()
@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+CACHE_VERSION = 1       # Part of every key - increase when the engines change their results
+
+
+def cache_key(*arrays, **params) -> str:
+    """
+        cache_key(*arrays, **params)
+
+    Returns a stable hash (hex string) of the given parameters and arrays.\n
+    Parameters are hashed by value (sorted by name), arrays by dtype, shape and content.
+    """
+    h = hashlib.sha256()
+    params["cache_version"] = CACHE_VERSION
+    h.update(json.dumps(params, sort_keys=True, default=lambda o: o.item() if hasattr(o, "item") else repr(o)).encode())
+    for arr in arrays:
+        arr = np.ascontiguousarray(arr)
+        h.update("{}{}".format(arr.dtype.str, arr.shape).encode())
+        h.update(arr.data)
+    return h.hexdigest()
+
+
+class SimulationCache: # Result cache
+    """
+        This class stores completed simulation results (profiles and junction depths) by their cache_key.\n
+        Results are kept in memory with LRU eviction, and optionally in a directory as .npz files with a size cap.\n
+        Stored and returned arrays are copies, so engines can keep reusing their buffers.
+    """
+    def __init__(self, max_memory:int=256*2**20, directory:str=None, max_disk:int=1*2**30):
+        self.max_memory = max_memory                    #bytes
+        self.directory  = directory
+        self.max_disk   = max_disk                      #bytes
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()                    # GUI worker and GUI thread may use the same cache
+        self.hits = 0
+        self.misses = 0
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def get(self, key:str) -> dict:
+        """
+            get(key)
+
+        Returns a copy of the stored entry (name -> value), None if it is not in the cache.
+        """
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                self.memory.move_to_end(key)            # Most recently used
+        if entry is None:
+            entry = self._load(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._remember(key, entry)
+        self.hits += 1
+        return {name: np.array(val) if isinstance(val, np.ndarray) else val for name, val in entry.items()}
+
+    def put(self, key:str, entry:dict):
+        """
+            put(key, entry)
+
+        Stores an entry (name -> array or number) in memory and on disk (if a directory is set).
+        """
+        entry = {name: np.array(val) if isinstance(val, np.ndarray) else val for name, val in entry.items()}
+        self._remember(key, entry)
+        self._save(key, entry)
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+            self.memory_size = 0
+
+    def _remember(self, key:str, entry:dict):
+        size = sum(val.nbytes for val in entry.values() if isinstance(val, np.ndarray))
+        with self.lock:
+            old = self.memory.pop(key, None)            # Entries can be replaced (e.g. the latest state of a run)
+            if old is not None:
+                self.memory_size -= sum(val.nbytes for val in old.values() if isinstance(val, np.ndarray))
+            if size > self.max_memory:
+                return
+            self.memory[key] = entry
+            self.memory_size += size
+            while self.memory_size > self.max_memory:
+                _, old = self.memory.popitem(last=False)   # Least recently used
+                self.memory_size -= sum(val.nbytes for val in old.values() if isinstance(val, np.ndarray))
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.directory, key + ".npz")
+
+    def _load(self, key:str) -> dict:
+        if self.directory is None or not os.path.exists(self._path(key)):
+            return None
+        try:
+            entry = {}
+            with np.load(self._path(key)) as data:
+                for name in data.files:
+                    val = data[name]
+                    entry[name] = val if val.ndim else val.item()
+            os.utime(self._path(key))                   # Access time for the LRU eviction on disk
+        except (OSError, ValueError):
+            return None
+        return entry
+
+    def _save(self, key:str, entry:dict):
+        if self.directory is None:
+            return
+        tmp = "{}.{}.tmp.npz".format(self._path(key)[:-4], os.getpid())
+        np.savez(tmp, **entry)
+        os.replace(tmp, self._path(key))
+
+        # Remove least recently used files above the size cap
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".npz") and ".tmp" not in name]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(name) for name in files)
+        while total > self.max_disk and files:
+            name = files.pop(0)
+            total -= os.path.getsize(name)
+            os.remove(name)
@@ -0,0 +1,41 @@
+import os
+import numpy as np
+
+CHECKPOINT_VERSION = 1  # Increase when the stored state changes
+
+
+def save_checkpoint(path:str, profile:np.array, x:np.array=None, **state):
+    """
+        save_checkpoint(path, profile, x=None, **state)
+
+    Writes the solver state to a binary .npz file: the profile (in its own precision), the mesh positions if any,\n
+    and the scalar state (step index, simulated time, parameters, solver settings). None is stored as NaN.\n
+    The file is written to a temporary name and renamed, so a crash never leaves a broken checkpoint.
+    """
+    entry = {name: np.nan if val is None else val for name, val in state.items()}
+    entry["version"] = CHECKPOINT_VERSION
+    entry["profile"] = profile
+    if x is not None:
+        entry["x"] = x
+    tmp = "{}.{}.tmp.npz".format(path[:-4] if path.endswith(".npz") else path, os.getpid())
+    np.savez(tmp, **entry)
+    os.replace(tmp, path)
+
+
+def load_checkpoint(path:str) -> dict:
+    """
+        load_checkpoint(path)
+
+    Returns the state written by save_checkpoint (name -> value, arrays for the profile and x), None if it cannot be read.
+    """
+    try:
+        state = {}
+        with np.load(path) as data:
+            for name in data.files:
+                val = data[name]
+                state[name] = val if val.ndim else val.item()
+    except (OSError, ValueError):
+        return None
+    if state.get("version") != CHECKPOINT_VERSION:
+        return None
+    return state
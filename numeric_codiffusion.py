@@ -0,0 +1,108 @@
+import math
+import numpy as np
+
+from numeric_sim import N_simulation, ProgressReporter, junction_depth
+from numeric_sweep import lumerical_on_budget_batch
+
+
+class N_codiffusion: # Multi-dopant simulation
+    """
+        This class diffuses several dopants at the same time, as one (species x points) array.\n
+        All species are advanced together by the batched explicit kernel with their own coefficients,\n
+        using the time step of the fastest one. Dopants do not interact (constant diffusivity physics).\n
+        Net doping is donors - acceptors + N_sub, its sign changes are the metallurgical junctions.
+    """
+    def __init__(self, dopants:list=None, T:float=900, N_sub:float=0, verbose:bool=True):
+        """
+        Parameters:
+        --------------------------------
+        dopants   -   Dopants of the simulation                       : list of Impurity
+        T         -   Temperature for process (degree C)              : float
+        N_sub     -   Substrate doping, negative for p-type (atoms/cm^3) : float
+        """
+        self.sims  = [N_simulation(dopant, T, verbose=False) for dopant in dopants]
+        self.sign  = np.array([1.0 if dopant.donor else -1.0 for dopant in dopants])
+        self.N_sub = N_sub
+        self.x_step = self.sims[0].x_step
+        self.set_temperature(T)
+        if verbose:
+            print("Position step: ", self.x_step)
+            print("Time step limit: ", self.t_step_limit)
+
+    def set_temperature(self, T:float=900):
+        """
+            set_temperature(T=900)
+
+        Sets the process temperature of every species, the common stability limit is the one of the fastest species.
+        """
+        for sim in self.sims:
+            sim.set_temperature(T)
+        self.D = np.array([sim.D for sim in self.sims])
+        self.t_step_limit = min(sim.t_step_limit for sim in self.sims)
+
+    def create_profiles(self, xL:float=6e-5) -> np.array:
+        """
+            create_profiles(xL=6e-5)
+
+        Returns an empty (species x points) profile array for a wafer of depth xL.
+        """
+        return np.zeros((len(self.sims), int(xL/self.x_step)+1))
+
+    def run(self, C:np.array=None, t:float=0, process=1, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> np.array:
+        """
+            run(C, t=0, process=1, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Diffuses all species for t seconds and returns the new (species x points) array.\n
+        process is 0 (predep., surface at the C0 of the species) or 1 (no flux), for all species or one per species.\n
+        The time step is the largest one below the stability limit that lands exactly on t.
+
+        Parameters:
+        --------------------------------
+        C        -   Profiles, one row per species (atoms/cm^3)      : np.array (2D)
+        t        -   Process time (seconds)                          : float
+        process  -   Selected process (predep./drive-in)             : bool/list
+        """
+        process = np.broadcast_to(np.asarray(process), (len(self.sims),))
+        if t <= 0:
+            return np.array(C, dtype=float)
+        n = max(int(math.ceil(t/self.t_step_limit - 1e-9)), 1)
+        t_step = t/n
+        coef = self.D*t_step/(self.x_step**2)
+        C_s  = np.array([sim.C0 if p == 0 else np.nan for sim, p in zip(self.sims, process)])
+        progress = ProgressReporter(n+1, progressPercentageOutput, progressRateOutput, lambda: self.terminateFlag, self.sims[0].progressInterval)
+        return lumerical_on_budget_batch(C, coef, np.full(len(self.sims), n+1), C_s, 0, progress, progressOutput)
+
+    def net_doping(self, C:np.array) -> np.array:
+        """
+            net_doping(C)
+
+        Returns the net doping (atoms/cm^3): donors - acceptors + N_sub.
+        """
+        return self.sign @ C + self.N_sub
+
+    def metallurgical_junctions(self, C:np.array) -> np.array:
+        """
+            metallurgical_junctions(C)
+
+        Returns the depths (cm) of all points where the net doping changes sign, from the surface down.\n
+        Each depth is interpolated linearly between the two points around the sign change.
+        """
+        net = self.net_doping(C)
+        positive = net > 0
+        i = np.flatnonzero(positive[:-1] != positive[1:])
+        return (i + net[i]/(net[i] - net[i+1]))*self.x_step
+
+    def junction_depths(self, C:np.array, Cth=1e15) -> np.array:
+        """
+            junction_depths(C, Cth=1e15)
+
+        Returns the junction depth of every species against Cth (see junction_depth).
+        """
+        return np.array([junction_depth(row, Cth, self.x_step) for row in C])
+
+    @property
+    def terminateFlag(self) -> bool:
+        return self.sims[0].terminateFlag
+
+    def terminate(self):
+        self.sims[0].terminate()
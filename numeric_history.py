@@ -0,0 +1,151 @@
+import os
+import json
+import numpy as np
+
+
+class SnapshotHistory: # On-disk time evolution
+    """
+        This class writes profile snapshots into a preallocated .npy file (np.memmap through open_memmap),\n
+        so the time evolution of a long run never has to fit in memory. Rows are snapshots, columns are depth points.\n
+        A JSON sidecar (path + ".json") holds the snapshot times, junction depths, grid and run parameters.\n
+        The file grows (doubles) if more snapshots come than the capacity. Only close() writes the sidecar.
+    """
+    def __init__(self, path:str, x_i:int=1, capacity:int=16, dtype=np.float64, x_step:float=1e-7, x:np.array=None, params:dict=None):
+        """
+        Parameters:
+        --------------------------------
+        path      -   History file (.npy)                             : str
+        x_i       -   Points of a profile                             : int
+        capacity  -   Expected number of snapshots                    : int
+        dtype     -   Stored precision                                : np.dtype
+        x_step    -   Position step (cm)                              : float
+        x         -   Point positions of a mesh (cm), None: uniform   : np.array
+        params    -   Run parameters for the sidecar                  : dict
+        """
+        self.path = path
+        self.x_i = x_i
+        self.dtype = np.dtype(dtype)
+        self.meta = {"x_step": x_step, "x": None if x is None else [float(v) for v in x], "params": params or {}, "times": [], "xjunc": []}
+        self._data = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(max(int(capacity), 1), x_i))
+
+    def __len__(self) -> int:
+        return len(self.meta["times"])
+
+    def append(self, t:float, profile:np.array, xjunc:float=0):
+        """
+            append(t, profile, xjunc=0)
+
+        Writes a snapshot at process time t (seconds) to the next row.
+        """
+        n = len(self)
+        if n == self._data.shape[0]:
+            self._grow()
+        self._data[n] = profile
+        self.meta["times"].append(float(t))
+        self.meta["xjunc"].append(float(xjunc))
+
+    def _grow(self):
+        """
+            _grow()
+
+        Doubles the capacity: rows are copied in blocks to a new file that replaces the old one.
+        """
+        n, x_i = self._data.shape
+        tmp = "{}.{}.tmp.npy".format(self.path[:-4] if self.path.endswith(".npy") else self.path, os.getpid())
+        try:
+            data = np.lib.format.open_memmap(tmp, mode="w+", dtype=self.dtype, shape=(2*n, x_i))
+            block = max(1, 2**24//max(x_i*self.dtype.itemsize, 1))  # ~16 MB per copy
+            for i in range(0, n, block):
+                data[i:min(i+block, n)] = self._data[i:min(i+block, n)]
+            data.flush()
+        except (OSError, ValueError):
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._data.flush()
+        del self._data
+        os.replace(tmp, self.path)
+        self._data = data
+
+    def close(self):
+        """
+            close()
+
+        Flushes the snapshots and writes the sidecar. The file keeps its capacity, readers use the count of the sidecar.
+        """
+        if self._data is None:
+            return
+        self._data.flush()
+        self._data = None
+        self.meta["count"] = len(self)
+        tmp = self.path + ".json.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self.path + ".json")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnapshotReader: # Lazy reader of a SnapshotHistory
+    """
+        This class opens a history written by SnapshotHistory without loading it: the file is memory mapped read-only,\n
+        so slicing by time or depth reads only the touched rows and columns from disk.\n
+        Indexing (reader[i], reader[i:j, a:b]) returns memory mapped views; at(), between() and depth() return arrays.
+    """
+    def __init__(self, path:str):
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        self.path = path
+        self.count = meta["count"]
+        self.times = np.array(meta["times"])            #seconds
+        self.xjunc = np.array(meta["xjunc"])            #cm
+        self.params = meta["params"]
+        self._data = np.load(path, mmap_mode="r")[:self.count]
+        self.x = np.arange(self._data.shape[1])*meta["x_step"] if meta["x"] is None else np.array(meta["x"])    #cm
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index):
+        return self._data[index]
+
+    def index(self, t:float=0) -> int:
+        """
+            index(t=0)
+
+        Returns the index of the snapshot closest to process time t (seconds).
+        """
+        return int(np.argmin(np.abs(self.times - t)))
+
+    def at(self, t:float=0) -> np.array:
+        """
+            at(t=0)
+
+        Returns the profile of the snapshot closest to process time t (seconds).
+        """
+        return np.array(self._data[self.index(t)])
+
+    def between(self, t_start:float=0, t_end:float=np.inf) -> tuple:
+        """
+            between(t_start=0, t_end=inf)
+
+        Returns (times, profiles) of the snapshots with t_start <= t <= t_end.
+        """
+        i = np.searchsorted(self.times, t_start, side="left")
+        j = np.searchsorted(self.times, t_end, side="right")
+        return self.times[i:j], np.array(self._data[i:j])
+
+    def depth(self, x:float=0) -> tuple:
+        """
+            depth(x=0)
+
+        Returns (times, concentrations) at depth x (cm) over the whole history, linear between the two nearest points.
+        """
+        i = int(np.clip(np.searchsorted(self.x, x) - 1, 0, self.x.size-2))
+        f = min(max((x - self.x[i])/(self.x[i+1] - self.x[i]), 0), 1)
+        cols = np.array(self._data[:, i:i+2], dtype=float)
+        return self.times, (1 - f)*cols[:, 0] + f*cols[:, 1]
@@ -0,0 +1,190 @@
+import math
+
+from numeric_sim import N_simulation, C_profiles, ArrheniusTable, junction_depth
+
+
+class RecipeStep: # One furnace step
+    """
+        This class contains one step of a thermal recipe: boundary type, duration and temperature profile.\n
+        process 0 keeps the surface at the solid solubility C0 (predep.), process 1 has no flux at the surface\n
+        (drive-in, inert anneal, ramps).\n
+        T is a temperature (degree C), a (T_start, T_end) pair for a linear ramp, or a function of the time in the step.
+    """
+    def __init__(self, process:bool=1, t:float=0, T=900, name:str=""):
+        self.process = process
+        self.t = t                                      #seconds
+        self.T = T                                      #°C
+        self.name = name
+
+    def temperature(self, t:float=0) -> float:
+        """
+            temperature(t=0)
+
+        Returns the temperature (degree C) at t seconds into the step.
+        """
+        if callable(self.T):
+            return self.T(t)
+        if isinstance(self.T, (tuple, list)):
+            T_start, T_end = self.T
+            return T_start + (T_end - T_start)*(t/self.t if self.t > 0 else 0)
+        return self.T
+
+    def segments(self, dT:float=1.0) -> int:
+        """
+            segments(dT=1.0)
+
+        Returns the number of segments the step is divided into, so T changes by at most dT within a segment.
+        """
+        if isinstance(self.T, (int, float)):
+            return 1
+        T = [self.temperature(self.t*k/100) for k in range(101)]
+        if callable(self.T):                            # Total variation, the profile may go up and down
+            span = sum(abs(T[k+1] - T[k]) for k in range(100))
+        else:
+            span = abs(T[-1] - T[0])
+        return max(1, int(math.ceil(span/dT)))
+
+
+class Recipe: # Thermal recipe pipeline
+    """
+        This class runs an ordered list of RecipeSteps on one profile.\n
+        Every step is divided into segments with at most dT of temperature change, each segment is run with the mean\n
+        diffusivity of the segment (Simpson's rule on an ArrheniusTable) by one N_simulation that is carried through the recipe.\n
+        Explicit segments use a time step that lands exactly on the end of the segment.\n
+        With collapse, consecutive steps with the same boundary type are reduced to their thermal budget (integral of D dt)\n
+        and solved once, at constant cost for any length of schedule with the implicit engine.
+    """
+    def __init__(self, dopant=None, xL:float=6e-5, Cb:float=0, Cth:float=1e15, engine:str="vector", accuracy:float=1e-4, dT:float=1.0, mesh=None, collapse:bool=False):
+        """
+        Parameters:
+        --------------------------------
+        dopant    -   Dopant of the recipe                            : Impurity
+        xL        -   Spatial length (cm)                             : float
+        Cb        -   Bottom concentration clip (atoms/cm^3)          : float
+        Cth       -   Threshold (backgrnd) concentration (atoms/cm^3) : float
+        engine    -   Selected engine (loop/vector/implicit/nonlinear/adaptive) : str
+        accuracy  -   Target relative error of the implicit/adaptive engine : float
+        dT        -   Largest temperature change in a segment (°C)    : float
+        mesh      -   Non-uniform grid (see Mesh)                     : Mesh
+        collapse  -   Solve steps by their thermal budget             : bool
+        """
+        self.dopant = dopant
+        self.xL = xL
+        self.Cb = Cb
+        self.Cth = Cth
+        self.engine = engine
+        self.accuracy = accuracy
+        self.dT = dT
+        self.collapse = collapse
+        self.steps = []
+        self.table = ArrheniusTable(dopant)
+        self.sim = N_simulation(dopant, verbose=False, mesh=mesh)
+
+    def add(self, process:bool=1, t:float=0, T=900, name:str=""):
+        """
+            add(process=1, t=0, T=900, name="")
+
+        Appends a step to the recipe (see RecipeStep). Returns the recipe, so calls can be chained.
+        """
+        self.steps.append(RecipeStep(process, t, T, name))
+        return self
+
+    def run(self, C:C_profiles=None, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> list:
+        """
+            run(C=None, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Runs all steps in order, starting from C (a wafer filled with Cb if not given).\n
+        Returns a list of (name, profile, xjunc) after every step (every collapsed group), the profiles are copies.\n
+        The latest profile is left in C.Cold. Percentage is the progress of the whole recipe.
+        """
+        sim = self.sim
+        if C is None:
+            x_i = int(self.xL/sim.x_step)+1 if sim.mesh is None else sim.mesh.size()
+            C = C_profiles(x_i=x_i, Cb=self.Cb)
+
+        total = sum(step.t for step in self.steps)
+        done = 0.0
+        percent = [-1]
+        results = []
+        for group in self._groups():
+            xjunc = junction_depth(C.Cold.get_profile(), self.Cth, sim.x_step, x=None if sim.mesh is None else sim.mesh.x)
+            for T_m, D, t_seg, t_real in self._segments(group):
+                sim.set_temperature(T_m, D)
+
+                t_j = None
+                if self.engine in ("implicit", "nonlinear"):
+                    sim.t_step = sim.implicit_time_step(t_seg, self.accuracy)
+                    t_j = int(round(t_seg/sim.t_step))+1
+                elif self.engine != "adaptive":
+                    n = max(int(math.ceil(t_seg/sim.t_step_limit - 1e-9)), 1)
+                    sim.t_step = t_seg/n                # Lands exactly on the end of the segment
+                    t_j = n+1
+
+                def segmentPercentage(p, t_done=done, t_real=t_real):
+                    p = int(100*(t_done + p/100*t_real)/total) if total > 0 else 100
+                    if p != percent[0]:
+                        percent[0] = p
+                        progressPercentageOutput(p)
+
+                quiet = lambda *args, **kwargs: None
+                _, xjunc = sim.lumerical_on_budget(C, self.Cb, self.Cth, t_j=t_j or 1, process=group[0].process, engine=self.engine, cache=cache,
+                                                   t=t_seg, rtol=self.accuracy, progressPercentageOutput=segmentPercentage,
+                                                   progressOutput=quiet, progressRateOutput=progressRateOutput)
+                done += t_real
+                if sim.terminateFlag:
+                    progressOutput("Simulation is terminated.")
+                    return results
+            name = " + ".join(step.name or "Step {}".format(self.steps.index(step)+1) for step in group)
+            results.append((name, C.Cold.copy(), xjunc))
+            progressOutput("{}: junction depth {}".format(name, xjunc))
+        return results
+
+    def _groups(self) -> list:
+        """
+            _groups()
+
+        Returns the steps as a list of groups: one group per step, or runs of steps with the same boundary type with collapse.
+        """
+        groups = []
+        for step in self.steps:
+            if self.collapse and groups and groups[-1][0].process == step.process:
+                groups[-1].append(step)
+            else:
+                groups.append([step])
+        return groups
+
+    def _segments(self, group:list) -> list:
+        """
+            _segments(group)
+
+        Returns the runs of a group as (temperature, diffusivity, simulated time, process time) tuples.\n
+        A collapsed group is one run of its thermal budget at its highest temperature.
+        """
+        if self.collapse:
+            t_real = sum(step.t for step in group)
+            if t_real <= 0:
+                return []
+            Dt = sum(self.table.budget(step.T, step.t, self.dT) for step in group)
+            T_ref = max(step.temperature(step.t*k/100) for step in group for k in range(101))
+            D = self.table(T_ref)
+            return [(T_ref, D, Dt/D, t_real)]
+
+        step = group[0]
+        if step.t <= 0:
+            return []
+        n_seg = step.segments(self.dT)
+        t_seg = step.t/n_seg
+        segments = []
+        for k in range(n_seg):
+            # Mean diffusivity of the segment
+            T_a, T_m, T_b = (step.temperature(t_seg*(k + f)) for f in (0, 0.5, 1))
+            D = (self.table(T_a) + 4*self.table(T_m) + self.table(T_b))/6
+            segments.append((T_m, D, t_seg, t_seg))
+        return segments
+
+    @property
+    def terminateFlag(self) -> bool:
+        return self.sim.terminateFlag
+
+    def terminate(self):
+        self.sim.terminate()
@@ -5,31 +5,104 @@
 ###########################################
 
 import sys
+import math
+import threading
+import time
+import bisect
 import numpy as np
 import matplotlib.pyplot as plt
+from numeric_cache import cache_key
+from numeric_history import SnapshotHistory
+from numeric_checkpoint import save_checkpoint, load_checkpoint
+try:
+    from scipy.linalg import solve_banded   # Optional - LAPACK banded solver, pure Python Thomas algorithm is used otherwise
+except ImportError:
+    solve_banded = None
+try:
+    from scipy.special import erfc          # Optional - vectorized erfc, math.erfc is used element by element otherwise
+except ImportError:
+    erfc = np.vectorize(math.erfc, otypes=[float])
 # import argparse
 # from numpy.lib.stride_tricks import as_strided as ast
 
 class Impurity:     # Dopant properties - TODO: CHECK "Co". It may depend on temperature.
     """
-        This class contains attributes and properties of an impurity object.
+        This class contains attributes and properties of an impurity object.\n
+        vacancy is the list of (D0, Ea, k) charge state terms of the concentration dependent diffusivity\n
+        D = sum(D0*exp(-Ea/kT)*(n/ni)^k), used by the "nonlinear" engine.\n
+        donor is False for acceptors (B), it sets the sign of the dopant in the net doping.
     """
-    def __init__(self, Do:float, Ea:float, Co:float):
+    def __init__(self, Do:float, Ea:float, Co:float, vacancy:list=None, donor:bool=True):
         self.Do = Do
         self.Ea = Ea
         self.Co = Co 
+        self.vacancy = vacancy
+        self.donor = donor
     
     def get_attr(self) -> tuple:
         return (self.Do, self.Ea, self.Co)
 
 
+class ArrheniusTable: # Tabulated diffusivity
+    """
+        This class tabulates D(T) = D0*exp(-Ea/(k*T)) of an impurity once on a fine temperature grid.\n
+        Lookups interpolate the table linearly, so no exp is evaluated per time step.\n
+        Relative error of the default 0.1 °C spacing is below 1e-5 above 500 °C. Temperatures outside the table are calculated directly.
+    """
+    def __init__(self, dopant:Impurity=None, T_min:float=500, T_max:float=1400, dT:float=0.1, Boltzmann:float=8.617e-5):
+        self.D0 = dopant.Do                             #cm^2/s
+        self.Ea = dopant.Ea                             #eV
+        self.Boltzmann = Boltzmann                      #eV/K
+        self.T_list = np.arange(T_min, T_max + dT/2, dT)    #°C
+        self.D_list = self.D0*np.exp(-self.Ea/(self.Boltzmann*(self.T_list + 273.15)))
+
+    def __call__(self, T):
+        """
+            table(T)
+
+        Returns D (cm^2/s) at T (degree C), T may be a number or an array.
+        """
+        D = np.interp(T, self.T_list, self.D_list)
+        outside = (np.asarray(T) < self.T_list[0]) | (np.asarray(T) > self.T_list[-1])
+        if np.any(outside):
+            D = np.where(outside, self.D0*np.exp(-self.Ea/(self.Boltzmann*(np.asarray(T, dtype=float) + 273.15))), D)
+        return D if np.ndim(D) else float(D)
+
+    def budget(self, T=900, t:float=0, dT:float=1.0) -> float:
+        """
+            budget(T=900, t=0, dT=1.0)
+
+        Returns the thermal budget, integral of D dt (cm^2), of t seconds at the temperature T.\n
+        T is a temperature (degree C), a (T_start, T_end) pair for a linear ramp, or a function of time.\n
+        Ramps are integrated with Simpson's rule on panels with at most dT of temperature change.
+        """
+        if t <= 0:
+            return 0.0
+        if not callable(T) and not isinstance(T, (tuple, list)):
+            return self(T)*t
+        if callable(T):
+            T_fun = T
+            T_s = np.array([T_fun(t*k/100) for k in range(101)])
+            span = np.sum(np.abs(np.diff(T_s)))         # Total variation, the profile may go up and down
+        else:
+            T_start, T_end = T
+            T_fun = lambda t_k: T_start + (T_end - T_start)*t_k/t
+            span = abs(T_end - T_start)
+        n = max(1, int(math.ceil(span/dT)))
+        t_k = np.linspace(0, t, 2*n+1)
+        D = self(np.array([T_fun(t_i) for t_i in t_k]) if callable(T) else T_fun(t_k))
+        return t/(6*n)*(D[0] + 4*np.sum(D[1::2]) + 2*np.sum(D[2:-1:2]) + D[-1])
+
+
 class _C_profile:   #Concentration profile
     """
         This class contains attributes and properties of a concentration profile object.\n
-        Extends C_profiles class.
+        Extends C_profiles class. arr may be a view of the buffer of a C_profiles object.
     """
-    def __init__(self, x_i:int=1, Cb:float=0):
-        self.arr = np.ones(x_i)*Cb   # Creates a blank concentration profile when initialized
+    __slots__ = ("arr",)
+
+    def __init__(self, x_i:int=1, Cb:float=0, arr:np.array=None, dtype=np.float64):
+        self.arr = np.full(x_i, Cb, dtype=dtype) if arr is None else arr  # Creates a blank concentration profile when initialized
 
     def size(self) -> int:
         return self.arr.size
@@ -44,21 +117,52 @@ class _C_profile:   #Concentration profile
         return self.arr
     
     def cut_initial(self):
-        self.arr = self.arr[1:]
+        self.arr = self.arr[1:]     # View, the profile is not copied
+
+    def copy(self):
+        return _C_profile(arr=self.arr.copy())
 
 
 class C_profiles:   # Conc. profiles at two different times
     """
         This object contains two concentration profiles at two different times.\n
-        Concentration profile is a 1D array that contains the concentration values of a dopant at sampled positions.
+        Concentration profile is a 1D array that contains the concentration values of a dopant at sampled positions.\n
+        Both profiles are rows of one preallocated buffer. Cnew and Cold are fixed views of the rows, selected by an index,\n
+        so swapping the time levels is O(1) and never allocates. Assigning a profile copies its values into the buffer.\n
+        dtype=np.float32 halves the memory and bandwidth of the profiles. Its range (1e-38 to 3e38 atoms/cm^3) covers\n
+        all dopants without scaling, the relative precision is ~1e-7.
     """
+    __slots__ = ("_buffer", "_rows", "_new")
+
+    def __init__(self, x_i:int=1, Cb:float=0, dtype=np.float64):
+        self._buffer = np.full((2, x_i), Cb, dtype=dtype)                   # Blank concentration profiles for t_j and t_j-1
+        self._rows = (_C_profile(arr=self._buffer[0]), _C_profile(arr=self._buffer[1]))
+        self._new = 0                                                       # Row of t_j, the other one is t_j-1
+
+    @property
+    def Cnew(self) -> _C_profile:
+        return self._rows[self._new]
 
-    def __init__(self, x_i:int=1, Cb:float=0):
-        self.Cnew = _C_profile(x_i, Cb)   # Creates a blank concentration profile for t_j when initialized
-        self.Cold = _C_profile(x_i, Cb)   # Creates a blank concentration profile for t_j-1 when initialized
+    @Cnew.setter
+    def Cnew(self, C:_C_profile):
+        self._copy_into(C, self._new)
+
+    @property
+    def Cold(self) -> _C_profile:
+        return self._rows[1 - self._new]
+
+    @Cold.setter
+    def Cold(self, C:_C_profile):
+        self._copy_into(C, 1 - self._new)
+
+    def _copy_into(self, C:_C_profile, row:int):
+        if C.size() != self.size():
+            print("Size mismatch. Profile not set.")
+        elif C.arr is not self._buffer[row]:
+            self._buffer[row] = C.arr
     
     def create_empty_profile(self, x_i:int=1, Cb:float=0) -> _C_profile:
-        return _C_profile(x_i, Cb)
+        return _C_profile(x_i, Cb, dtype=self._buffer.dtype)
     
     def make_profiles(self, Cnew:_C_profile, Cold:_C_profile):
         self.Cnew = Cnew
@@ -76,42 +180,446 @@ class C_profiles:   # Conc. profiles at two different times
             print("Invalid index.")
 
     def size(self) -> int:
-        return self.Cnew.size()
+        return self._buffer.shape[1]
 
     def update_profiles(self, Cij:_C_profile):
+        """
+            update_profiles(Cij)
+
+        Cij becomes the profile of t_j and the previous t_j profile becomes t_j-1.\n
+        Values are copied, so Cij may also be Cnew itself.
+        """
         if self.size() == Cij.size():
-            self.Cold = self.Cnew
+            self.swap_profiles()
             self.Cnew = Cij
         else:
             print("Size mismatch. Profiles not updated.")
 
+    def swap_profiles(self):
+        self._new ^= 1                  # t_j becomes t_j-1, old buffer is reused for the next t_j
+
+
+def solve_tridiagonal(a, b, c, d) -> np.array:
+    """
+        solve_tridiagonal(a, b, c, d)
+
+    Solves a[i]*x[i-1] + b[i]*x[i] + c[i]*x[i+1] = d[i] with the Thomas algorithm in O(N).\n
+    a[0] and c[-1] are not used. Coefficients may be scalars or arrays.\n
+    If d is 2D, every row is solved as an independent system at once.\n
+    Rows that share 1D coefficients are solved as one banded system with many right hand sides if scipy is available.
+
+    Parameters:
+    --------------------------------
+    a   -   Lower diagonal      : float/np.array
+    b   -   Main diagonal       : float/np.array
+    c   -   Upper diagonal      : float/np.array
+    d   -   Right hand side     : np.array
+    """
+    d = np.asarray(d, dtype=float)
+    n = d.shape[-1]
+    if d.ndim == 2 and solve_banded is not None and max(np.ndim(a), np.ndim(b), np.ndim(c)) <= 1:
+        ab = np.zeros((3, n))
+        ab[0, 1:]  = np.broadcast_to(c, (n,))[:-1]
+        ab[1, :]   = np.broadcast_to(b, (n,))
+        ab[2, :-1] = np.broadcast_to(a, (n,))[1:]
+        return solve_banded((1, 1), ab, d.T).T
+    a = np.broadcast_to(a, d.shape)
+    b = np.broadcast_to(b, d.shape)
+    c = np.broadcast_to(c, d.shape)
+
+    if d.ndim == 1:
+        if solve_banded is not None:
+            ab = np.zeros((3, n))
+            ab[0, 1:]  = c[:-1]
+            ab[1, :]   = b
+            ab[2, :-1] = a[1:]
+            return solve_banded((1, 1), ab, d)
+        a, b, c, d = a.tolist(), b.tolist(), c.tolist(), d.tolist()     # Python floats are faster than numpy scalars here
+        cp = [0.0]*n
+        dp = [0.0]*n
+        cp[0] = c[0]/b[0]
+        dp[0] = d[0]/b[0]
+        for i in range(1, n):
+            m = b[i] - a[i]*cp[i-1]
+            cp[i] = c[i]/m
+            dp[i] = (d[i] - a[i]*dp[i-1])/m
+        for i in range(n-2, -1, -1):
+            dp[i] -= cp[i]*dp[i+1]
+        return np.array(dp)
+
+    # Stacked systems: loop along the system, vectorize across the rows
+    cp = np.empty(d.shape)
+    dp = np.empty(d.shape)
+    cp[..., 0] = c[..., 0]/b[..., 0]
+    dp[..., 0] = d[..., 0]/b[..., 0]
+    for i in range(1, n):
+        m = b[..., i] - a[..., i]*cp[..., i-1]
+        cp[..., i] = c[..., i]/m
+        dp[..., i] = (d[..., i] - a[..., i]*dp[..., i-1])/m
+    for i in range(n-2, -1, -1):
+        dp[..., i] -= cp[..., i]*dp[..., i+1]
+    return dp
+
+
+def erfcinv(y:float) -> float:
+    """
+        erfcinv(y)
+
+    Inverse of the complementary error function for 0 < y < 2 (Newton iterations on math.erfc).
+    """
+    if y <= 0:
+        return float('inf')
+    if y >= 2:
+        return float('-inf')
+    if y > 1:
+        return -erfcinv(2 - y)
+    x = math.sqrt(-math.log(y)) if y < 0.5 else 0.5   # Asymptotic starting point for the tail
+    for _ in range(100):
+        dx = (math.erfc(x) - y) / (-2/math.sqrt(math.pi) * math.exp(-x*x))
+        x -= dx
+        if abs(dx) < 1e-14*max(1.0, abs(x)):
+            break
+    return x
+
+
+def junction_depth(arr:np.array, Cth=1e15, x_step:float=1e-7, interpolation:str="log", x:np.array=None):
+    """
+        junction_depth(arr, Cth=1e15, x_step=1e-7, interpolation="log", x=None)
+
+    Junction depth of a profile that decreases with depth (predep./drive-in profiles).\n
+    The crossing is found by bisection (O(log N)) and interpolated between the two points around it,\n
+    linearly in concentration ("linear") or in log-concentration ("log"), so it is not snapped to the grid.\n
+    Returns 0 if the profile is never above Cth, the depth of the last point if it never falls below Cth.\n
+    If Cth is a list/array, an array of junction depths is returned.
+
+    Parameters:
+    --------------------------------
+    arr            -   Concentration profile (atoms/cm^3)              : np.array
+    Cth            -   Threshold (backgrnd) concentration (atoms/cm^3) : float/list
+    x_step         -   Position step (cm)                              : float
+    interpolation  -   Sub-grid interpolation ("linear"/"log")         : str
+    x              -   Point positions of a non-uniform grid (cm)      : np.array
+    """
+    if np.ndim(Cth) > 0:
+        return np.array([junction_depth(arr, c, x_step, interpolation, x) for c in np.ravel(Cth)])
+
+    # First point at or below Cth
+    lo, hi = 0, arr.size
+    while lo < hi:
+        mid = (lo + hi)//2
+        if arr[mid] > Cth:
+            lo = mid+1
+        else:
+            hi = mid
+    return _crossing(arr, lo, Cth, x_step, interpolation, x)
+
+
+def _crossing(arr:np.array, i:int, Cth:float, x_step:float, interpolation:str="log", x:np.array=None) -> float:
+    """
+        _crossing(arr, i, Cth, x_step, interpolation="log", x=None)
+
+    Position of Cth between the points i-1 (above Cth) and i (at or below Cth).
+    """
+    if i <= 0:
+        return 0.0
+    if i >= arr.size:
+        return (arr.size-1)*x_step if x is None else float(x[-1])
+    C_a, C_b = float(arr[i-1]), float(arr[i])
+    if interpolation == "log" and C_b > 0 and Cth > 0:
+        frac = math.log(C_a/Cth)/math.log(C_a/C_b)
+    else:
+        frac = (C_a - Cth)/(C_a - C_b)
+    if x is None:
+        return (i-1 + frac)*x_step
+    return float(x[i-1] + frac*(x[i] - x[i-1]))
+
+
+class JunctionTracker: # Incremental junction depth
+    """
+        This class follows the junction of a profile from one time step to the next.\n
+        The crossing index is moved from its last position as the front advances, so every update is O(1) amortized.
+    """
+    def __init__(self, Cth:float=1e15, x_step:float=1e-7, interpolation:str="log", x:np.array=None):
+        self.Cth = Cth
+        self.x_step = x_step
+        self.interpolation = interpolation
+        self.x = x                                      # Point positions of a non-uniform grid
+        self.i = 0                                      # First point at or below Cth
+
+    def update(self, arr:np.array) -> float:
+        i, n, Cth = self.i, arr.size, self.Cth
+        while i < n and arr[i] > Cth:                   # Front advanced
+            i += 1
+        while i > 0 and arr[i-1] <= Cth:                # Front receded
+            i -= 1
+        self.i = i
+        return _crossing(arr, i, Cth, self.x_step, self.interpolation, self.x)
+
+
+class Mesh: # Non-uniform spatial grid
+    """
+        This class contains the point positions of a graded grid: fine near the surface and the junction, coarser with depth.\n
+        The diffusion operator is discretized with finite volumes, the surface point has a half cell.
+    """
+    def __init__(self, x:np.array=None):
+        self.x = np.asarray(x, dtype=float)             #cm - point positions, x[0] is the surface
+        self.h = np.diff(self.x)                        #cm - cell widths
+
+    @classmethod
+    def graded(cls, xL:float=6e-5, x_step:float=1e-7, x_dense:float=0, ratio:float=1.05, h_max:float=None):
+        """
+            Mesh.graded(xL=6e-5, x_step=1e-7, x_dense=0, ratio=1.05, h_max=None)
+
+        Spacing is x_step down to x_dense, then every cell is ratio times wider than the previous one (up to h_max) until xL.\n
+        x_dense should cover the junction, e.g. a few diffusion lengths 2*sqrt(D*t) of the whole process.
+
+        Parameters:
+        --------------------------------
+        xL       -   Spatial length (cm)                     : float
+        x_step   -   Finest position step (cm)               : float
+        x_dense  -   Depth of the uniform fine region (cm)   : float
+        ratio    -   Growth of the cell width with depth     : float
+        h_max    -   Widest position step (cm)               : float
+        """
+        n_dense = min(int(x_dense/x_step), int(xL/x_step))
+        x = list(np.arange(n_dense+1)*x_step)
+        h = x_step
+        while True:
+            h = h*ratio if h_max is None else min(h*ratio, h_max)
+            if x[-1] + h >= xL:
+                break
+            x.append(x[-1] + h)
+        if xL - x[-1] < 0.5*h and len(x) > 1:           # Merge a thin last cell into the previous one
+            x[-1] = xL
+        else:
+            x.append(xL)
+        return cls(x)
+
+    def size(self) -> int:
+        return self.x.size
+
+    def operator(self, Ddt:float=1) -> tuple:
+        """
+            operator(Ddt=1)
+
+        Returns (lower, upper, surface): coefficients of D*t_step*d2C/dx2 for the interior points,\n
+        Cnew[i] = Cold[i] + lower[i-1]*(Cold[i-1] - Cold[i]) + upper[i-1]*(Cold[i+1] - Cold[i]),\n
+        and of the no-flux surface point, Cnew[0] = Cold[0] + surface*(Cold[1] - Cold[0]).
+        """
+        h_l, h_r = self.h[:-1], self.h[1:]
+        lower = 2*Ddt/(h_l*(h_l + h_r))
+        upper = 2*Ddt/(h_r*(h_l + h_r))
+        surface = 2*Ddt/self.h[0]**2
+        return lower, upper, surface
+
+    def step_limit(self, D:float=1) -> float:
+        """
+            step_limit(D=1)
+
+        Returns the stability limit of the explicit engines (seconds), set by the finest cells.
+        """
+        lower, upper, surface = self.operator(D)
+        return 1/max(np.max(lower + upper), surface)
+
+
+class ProgressReporter: # Throttled progress output of the time loop
+    """
+        This class reports the progress of a time loop without paying for it at every time step.\n
+        Percentage is sent only when its integer value changes, steps/second and ETA every interval seconds.\n
+        Termination is checked at the same points, so it is read at least every interval seconds, not at every step.
+    """
+    def __init__(self, t_j:int=1, percentageOutput=print, rateOutput=None, terminateCheck=None, interval:float=0.1):
+        self.t_j = max(t_j, 1)
+        self.percentageOutput = percentageOutput
+        self.rateOutput = rateOutput
+        self.terminateCheck = terminateCheck
+        self.interval = interval
+
+        self.percent = -1
+        self.stride = 1                             # Steps between two checks, adapted to keep checks ~interval/4 apart
+        self.next_j = 0
+        self.t_check = self.t_rate = time.perf_counter()
+        self.j_rate = 0
+
+    def update(self, j:int) -> bool:
+        """
+            update(j)
+
+        Call at every time iteration j. Returns True if the simulation should be terminated.
+        """
+        if j < self.next_j:
+            return False
+
+        percent = 100*j//self.t_j
+        if percent != self.percent:
+            self.percent = percent
+            self.percentageOutput(percent)
+
+        now = time.perf_counter()
+        if now - self.t_check < self.interval/4:
+            self.stride *= 2
+        elif self.stride > 1:
+            self.stride //= 2
+        self.t_check = now
+
+        if now - self.t_rate >= self.interval and j > self.j_rate:
+            rate = (j - self.j_rate)/(now - self.t_rate)        # steps/second
+            if self.rateOutput is not None:
+                self.rateOutput(rate, (self.t_j - 1 - j)/rate)  # (steps/second, ETA in seconds)
+            self.t_rate, self.j_rate = now, j
+
+        # Next check at the next percentage change or after stride steps
+        self.next_j = min(-(-(percent+1)*self.t_j//100), j + self.stride)
+        return self.terminateCheck is not None and self.terminateCheck()
+
 
 class N_simulation: # Simulation class
     """
         This class performs numerical simulations using difference equation derived from diffusion equation.
     """
-    def __init__(self, dopant:Impurity=None, T:int=900):                                                                #DONE!
-        # Termination flag
-        self.terminateFlag = False
+    def __init__(self, dopant:Impurity=None, T:int=900, t_step:float=None, verbose:bool=True, mesh:Mesh=None, dtype=np.float64):                          #DONE!
+        # Termination flag - set from other threads (GUI), read by the engines through ProgressReporter
+        self._terminateEvent = threading.Event()
+        self.progressInterval = 0.1                     #seconds - wall-clock interval for rate/ETA output and termination checks
+        self.checkpointInterval = 60                    #seconds - wall-clock interval between checkpoints (see lumerical_on_budget)
+        self.frontTolerance = 0                         #atoms/cm^3 - points within this of Cb ahead of the diffusion front are not updated (0: exact)
+        self.accepted_steps = 0                         # Step counts of the last "adaptive" run
+        self.rejected_steps = 0
+        self.adaptive_time = 0.0                        # Process time reached by the last "adaptive" run (seconds)
+        self.adaptive_dt = 0.0                          # Next time step of the last "adaptive" run (seconds)
+        self._offset = (0, 0.0)                         # (steps, seconds) done before the running part of a resumed run
+        self._table = None                              # ArrheniusTable of thermal_budget, made on first use
 
         # Impurity parameters
         self.Ea = dopant.Ea                             #eV
         self.D0 = dopant.Do                             #cm^2/s
         self.C0 = dopant.Co                             #cm^-3
+        self.vacancy = dopant.vacancy                   # Charge state terms of D(C, T), None: constant D only
         
         # Constants
         self.Boltzmann = 8.617e-5                       #eV/K
         # self.x_step = 1e-8                              #cm (1 Angstrom)
         self.x_step = 1e-7                              #cm (1 nm)
-        print("Position step: ", self.x_step)
+        self.mesh = mesh                                # Non-uniform grid, None: uniform grid of x_step
+        self.dtype = dtype                              # Profiles of predeposition/drive_in, np.float32 for compact mode
+        if verbose:
+            print("Position step: ", self.x_step if mesh is None else "{} points, {} to {}".format(mesh.size(), mesh.h.min(), mesh.h.max()))
 
-        # Calculate diffusivity based on dopant
-        self.T = T + 273.15                             #convert °C to K 
-        self.D = self.diffusivity(self.T)    
+        # Calculate diffusivity based on dopant and time step for convergence
+        self.set_temperature(T)
+        self.t_step_user = t_step                       # Time step given by the user, None: set by the engines
+        if t_step is None:
+            self.t_step = self.t_step_limit
+        else:
+            self.t_step = t_step                            #seconds - user choice, only the implicit engine is stable above the limit
+            if self.t_step > self.t_step_limit:
+                print("Time step exceeds the explicit stability limit. Use engine=\"implicit\".")
+        if verbose:
+            print("Time step: ", self.t_step)    
+
+    def set_temperature(self, T:float=900, D:float=None):
+        """
+            set_temperature(T=900, D=None)
+
+        Sets the process temperature, the diffusivity (calculated if D is not given, e.g. from an ArrheniusTable)\n
+        and the explicit stability limit. t_step is reset to the limit.
+
+        Parameters:
+        --------------------------------
+        T   -   Temperature for process (degree C)  : float
+        D   -   Diffusivity at T (cm^2/s)           : float
+        """
+        self.T = T + 273.15                             #convert °C to K
+        self.D = self.diffusivity(self.T) if D is None else D
+        if self.vacancy is not None:                    # Charge state diffusivities and ni for D(C, T)
+            self.D_vacancy = [(D0*np.exp(-Ea/(self.Boltzmann*self.T)), k) for D0, Ea, k in self.vacancy]
+            self.ni = self.intrinsic_concentration(self.T)
+        if self.mesh is None:
+            self.t_step_limit = (self.x_step**2) / (2*self.D)   #seconds - stability limit of the explicit engines
+        else:
+            self.t_step_limit = self.mesh.step_limit(self.D)
+        self.t_step = self.t_step_limit
 
-        # Calculate time step for convergence
-        self.t_step = (self.x_step**2) / (2*self.D)     #seconds
-        print("Time step: ", self.t_step)    
+    def intrinsic_concentration(self, T=900) -> float:
+        """
+            intrinsic_concentration(T=900)
+
+        Intrinsic carrier concentration of silicon (cm^-3), T in K.
+        """
+        return 3.9e16*T**1.5*np.exp(-0.605/(self.Boltzmann*T))
+
+    def diffusivity_C(self, C:np.array) -> np.array:
+        """
+            diffusivity_C(C)
+
+        Concentration dependent diffusivity (cm^2/s) at the set temperature, vectorized over a profile:\n
+            D = sum(D_k*(n/ni)^k), n = C/2 + sqrt(C^2/4 + ni^2)\n
+        The dopant is taken as fully ionized and the only dopant, n is p for acceptors.
+        """
+        C = np.maximum(C, 0)
+        r = (0.5*C + np.sqrt(0.25*C*C + self.ni*self.ni))/self.ni
+        D = np.zeros_like(r)
+        for D_k, k in self.D_vacancy:
+            D += D_k*r**k if k else D_k
+        return D
+
+    def thermal_budget(self, schedule:list=None, dT:float=1.0) -> float:
+        """
+            thermal_budget(schedule, dT=1.0)
+
+        Returns the thermal budget, integral of D dt (cm^2), of a temperature schedule.\n
+        schedule is a list of (t, T) steps, T as in ArrheniusTable.budget.\n
+        With constant diffusivity physics, a drive-in depends only on this integral (see drive_in_budget).
+        """
+        if self._table is None:
+            self._table = ArrheniusTable(Impurity(self.D0, self.Ea, self.C0), Boltzmann=self.Boltzmann)
+        return sum(self._table.budget(T, t, dT) for t, T in schedule)
+
+    def time_iterations(self, t:float=0) -> int:
+        """
+            time_iterations(t=0)
+
+        Returns the number of time iterations (t_j) needed to reach the given process time.
+
+        Parameters:
+        --------------------------------
+        t   -   Process time (seconds)  : float
+        """
+        return int(t/self.t_step + 1e-9)+1             # Tolerance keeps t = n*t_step from being truncated to n-1 steps
+
+    def implicit_time_step(self, t:float=0, accuracy:float=1e-3, theta:float=0.5) -> float:
+        """
+            implicit_time_step(t=0, accuracy=1e-3, theta=0.5)
+
+        Returns a time step for the implicit engine that lands exactly on t.\n
+        Diffusion profiles evolve on the time scale of the process itself, so the relative\n
+        time discretization error is taken as (t_step/t)^2 for Crank-Nicolson (theta=0.5)\n
+        and t_step/t for backward Euler. The step is never made smaller than the explicit limit.
+
+        Parameters:
+        --------------------------------
+        t         -   Process time (seconds)                  : float
+        accuracy  -   Target relative error                   : float
+        theta     -   Implicitness (0.5: C-N, 1: B-E)         : float
+        """
+        if t <= 0:
+            return self.t_step_limit
+        if theta == 0.5:
+            t_step = t*np.sqrt(accuracy)
+        else:
+            t_step = t*accuracy
+        t_step = max(t_step, self.t_step_limit)
+        return t/max(int(np.ceil(t/t_step)), 1)
+
+    def positions(self, x_i:int=1) -> np.array:
+        """
+            positions(x_i=1)
+
+        Returns the positions (cm) of the x_i points of a profile, from the mesh if one is set.
+        """
+        if self.mesh is not None:
+            return self.mesh.x
+        return np.arange(x_i)*self.x_step
 
     def diffusivity(self, T=900) -> float:                                                                              #DONE!
         """
@@ -125,14 +633,29 @@ class N_simulation: # Simulation class
         """
         return (self.D0 * np.exp(-self.Ea/(self.Boltzmann) * (1/T)))
 
-    def lumerical_on_budget(self, C:C_profiles, Cb:float=0, Cth:float=1e15, t_j:int=1, process:bool=0, progressPercentageOutput=print, progressOutput=print) -> _C_profile:    #DONE!
+    def lumerical_on_budget(self, C:C_profiles, Cb:float=0, Cth:float=1e15, t_j:int=1, process:bool=0, progressPercentageOutput=print, progressOutput=print, engine:str="loop", theta:float=0.5, progressRateOutput=None, cache=None, t:float=None, rtol:float=1e-3, atol:float=None, history:str=None, snapshot_every:float=0, checkpoint:str=None) -> _C_profile:    #DONE!
         """
-            lumerical_on_budget(C, Cb=0, Cth=100, t_j=1, process=0, progressPercentageOutput=print, progressOutput=print)
+            lumerical_on_budget(C, Cb=0, Cth=100, t_j=1, process=0, progressPercentageOutput=print, progressOutput=print, engine="loop", theta=0.5, progressRateOutput=None, cache=None, t=None, rtol=1e-3, atol=None, history=None, snapshot_every=0, checkpoint=None)
             
         Numerically calculates the concentration profile of given dopant.\n
         Cb must be smaller than Cth.\n
         If process is 0 (set by default), calculation will be done for predeposition.\n
-        If process is 1, calculation will be done for drive-in.
+        If process is 1, calculation will be done for drive-in.\n
+        If engine is "loop" (set by default), every grid point is updated one by one.\n
+        If engine is "vector", the whole profile is updated at once with array slices.\n
+        If engine is "implicit", a tridiagonal system is solved every step. It is stable for any t_step.\n
+        If engine is "nonlinear", D depends on the concentration (see diffusivity_C and _nonlinear_engine).\n
+        If engine is "adaptive", the implicit engine is run with an error controlled time step that lands exactly on t (see _adaptive_engine).\n
+        If engine is "analytic", the closed form solution at t is returned (see analytic_on_budget).\n
+        t is (t_j-1)*t_step if it is not given, it is only used by the "adaptive" and "analytic" engines.\n
+        Progress percentage is sent when it changes, rate and ETA every progressInterval seconds (see ProgressReporter).\n
+        If a cache is given, a run with the same parameters, solver settings and initial profile is loaded instead of integrated\n
+        (Cth is not part of the key, only the junction depth is recalculated). If only a shorter run of it is stored,\n
+        the run is continued from the stored state and only the remaining interval is integrated (see _continue_from).\n
+        If a history path is given, snapshots are written to disk every snapshot_every seconds of process time and at the last step\n
+        (see SnapshotHistory, read with numeric_history.SnapshotReader). A run with a history is always integrated.\n
+        If a checkpoint path is given, the solver state is saved every checkpointInterval seconds of wall time and when the run\n
+        ends or is terminated (see resume).
         
         Parameters:
         --------------------------------
@@ -143,80 +666,853 @@ class N_simulation: # Simulation class
         process                  -   Selected process (predep./drive-in)             : bool
         progressPercentageOutput -   Function to print the progress percentage       : function
         progressOutput           -   Function to print the progress                  : function
+        engine                   -   Selected engine (loop/vector/implicit/nonlinear/adaptive/analytic) : str
+        theta                    -   Implicitness (0.5: C-N, 1: B-E)                 : float
+        progressRateOutput       -   Function to print steps/second and ETA          : function
+        cache                    -   Result cache (numeric_cache)                    : SimulationCache
+        t                        -   Process time (seconds)                          : float
+        rtol                     -   Relative tolerance of the "adaptive" engine     : float
+        atol                     -   Absolute tolerance (atoms/cm^3), rtol*1e-5*C0 if not given : float
+        history                  -   Snapshot history file (.npy)                    : str
+        snapshot_every           -   Process time between snapshots (seconds), 0: every step : float
+        checkpoint               -   Checkpoint file (.npz)                          : str
         """
 
         xjunc=0
-        coef = self.D*self.t_step/(self.x_step**2)
+
+        if process != 0 and process != 1:
+            progressOutput("Process not selected properly. Returning given profile.")
+            return C.Cold, xjunc
+
+        if t is None:
+            t = (t_j-1)*self.t_step
+        if engine == "analytic":
+            return self.analytic_on_budget(C, Cb, Cth, t, process)
+        if atol is None:                                # Independent of Cth, so a Cth edit only recalculates the junction depth
+            atol = rtol*1e-5*self.C0
+
+        # Profile does not depend on Cth, so it is not part of the key
+        entry = None
+        stored = None
+        if cache is not None:
+            grid = () if self.mesh is None else (self.mesh.x,)
+            run = dict(Ea=self.Ea, D0=self.D0, C0=self.C0, T=self.T, x_step=self.x_step, Cb=Cb, process=int(process), engine=engine, theta=theta,
+                       **({"rtol": rtol, "atol": atol} if engine == "adaptive" else {}),
+                       **({"vacancy": self.vacancy} if engine == "nonlinear" else {}),
+                       **({"frontTolerance": self.frontTolerance} if engine == "vector" else {}))
+            key = cache_key(C.Cold.get_profile(), *grid, t_step=self.t_step, t_j=t_j, **run, **({"t": t} if engine == "adaptive" else {}))
+            # Same run at any process time: the latest state is kept, so a longer run only integrates the rest
+            stem = "state-" + cache_key(C.Cold.get_profile(), *grid, **run, **({"t_step": self.t_step} if engine in ("loop", "vector") else {}))
+            if history is None:
+                entry = cache.get(key)
+                if entry is None:
+                    stored = cache.get(stem)
+
+        if entry is not None:
+            C.Cold.get_profile()[:] = entry["profile"]
+            progressOutput("Loaded from cache.")
+        else:
+            t_step = self.t_step
+            run_j, run_t, j0, t0 = t_j, t, 0, 0.0
+            continued = stored is not None and checkpoint is None and self._offset == (0, 0.0) and \
+                        (stored["j"] < t_j-1 if engine in ("loop", "vector") else stored["t"] < t*(1 - 1e-12))
+            if continued:
+                j0, t0 = stored["j"], stored["t"]
+                run_j, run_t = self._continue_from(C, stored, t_j, t, engine)
+                progressOutput("Continuing a stored run from {:.6g} s.".format(t0))
+            if engine == "adaptive":
+                # Progress in 1/10000 of the process time, rate in attempted steps/second
+                start = time.perf_counter()
+                rateOutput = None if progressRateOutput is None else \
+                    lambda rate, eta: progressRateOutput((self.accepted_steps + self.rejected_steps)/max(time.perf_counter() - start, 1e-9), eta)
+                progress = ProgressReporter(10000, progressPercentageOutput, rateOutput, lambda: self.terminateFlag, self.progressInterval)
+                steps = self._adaptive_engine(C, Cb, run_t, process, progress, progressOutput, theta, rtol, atol)
+            else:
+                progress = ProgressReporter(run_j, progressPercentageOutput, progressRateOutput, lambda: self.terminateFlag, self.progressInterval)
+                steps = self._engine(C, Cb, run_j, process, progress, progressOutput, engine, theta)
+            if steps is None:
+                progressOutput("Engine not selected properly. Returning given profile.")
+                return C.Cold, xjunc
+            if history is not None:
+                steps = self._record(steps, history, snapshot_every, C, Cb, Cth, t_j, t, process, engine, theta)
+            if checkpoint is not None:
+                state = {"Ea": self.Ea, "D0": self.D0, "C0": self.C0, "T": self.T - 273.15, "D": self.D, "x_step": self.x_step,
+                         "Cb": Cb, "Cth": Cth, "process": int(process), "engine": engine, "theta": theta, "t_step": self.t_step,
+                         "rtol": rtol, "atol": atol, "t_j": self._offset[0] + t_j, "t_end": self._offset[1] + t}
+                steps = self._checkpoints(steps, checkpoint, C, state)
+            try:
+                for _ in steps:
+                    pass
+                if engine == "adaptive":
+                    reached = (j0 + self.accepted_steps, t0 + self.adaptive_time)
+                else:
+                    reached = (j0 + run_j-1, t0 + (run_j-1)*self.t_step)
+            finally:
+                if continued:
+                    self.t_step, self._offset = t_step, (0, 0.0)
+            if engine == "adaptive":
+                progressOutput("Adaptive time steps: {} accepted, {} rejected.".format(self.accepted_steps, self.rejected_steps))
+            if cache is not None and not self.terminateFlag:
+                cache.put(key, {"profile": C.Cold.get_profile()})
+                if stored is None or reached[1] > stored["t"]:
+                    cache.put(stem, {"profile": C.Cold.get_profile(), "j": reached[0], "t": reached[1], "adaptive_dt": self.adaptive_dt})
+
+        # Find junction depth
+        xjunc = junction_depth(C.Cold.get_profile(), Cth, self.x_step, x=None if self.mesh is None else self.mesh.x)
+
+        Cn = C.Cold                                     # Latest time step is kept in Cold after the last swap
+        return Cn, xjunc
+
+    def _record(self, steps, path:str, snapshot_every:float, C:C_profiles, Cb:float, Cth:float, t_j:int, t:float, process:bool, engine:str, theta:float):
+        """
+            _record(steps, path, snapshot_every, C, Cb, Cth, t_j, t, process, engine, theta)
+
+        Passes the steps of the step generator on and writes snapshots to a SnapshotHistory at path.\n
+        The capacity is preallocated for the run, adaptive runs take a snapshot at the first step past every snapshot_every.
+        """
+        adaptive = engine == "adaptive"
+        if snapshot_every > 0:
+            capacity = int(t/snapshot_every)+2
+            every = max(1, int(round(snapshot_every/self.t_step)))
+        else:
+            capacity = t_j if not adaptive else 64
+            every = 1
+        params = {"Ea": self.Ea, "D0": self.D0, "C0": self.C0, "T": self.T - 273.15, "Cb": Cb, "Cth": Cth, "process": int(process),
+                  "engine": engine, "theta": theta, "t_step": self.t_step, "t": t}
+        tracker = JunctionTracker(Cth, self.x_step, x=None if self.mesh is None else self.mesh.x)
+        next_t = 0.0
+        with SnapshotHistory(path, C.size(), capacity, C.Cold.get_profile().dtype, self.x_step, None if self.mesh is None else self.mesh.x, params) as history:
+            for j, Cj in steps:
+                if adaptive:
+                    t_now = self.adaptive_time
+                    if t_now >= next_t*(1 - 1e-12) or t_now >= t:
+                        history.append(t_now, Cj, tracker.update(Cj))
+                        next_t = (int(t_now/snapshot_every + 1e-9)+1)*snapshot_every if snapshot_every > 0 else 0
+                elif j % every == 0 or j == t_j-1:
+                    history.append(j*self.t_step, Cj, tracker.update(Cj))
+                yield j, Cj
+
+    def _checkpoints(self, steps, path:str, C:C_profiles, state:dict):
+        """
+            _checkpoints(steps, path, C, state)
+
+        Passes the steps of the step generator on and saves checkpoints (see numeric_checkpoint) every checkpointInterval\n
+        seconds of wall time, and once more when the steps end. Step index and time count from the start of the whole run.
+        """
+        j0, t0 = self._offset
+        x = None if self.mesh is None else self.mesh.x
+        adaptive = state["engine"] == "adaptive"
+        save = lambda j, profile: save_checkpoint(path, profile, x, j=j0 + j, t=t0 + (self.adaptive_time if adaptive else j*self.t_step),
+                                                  adaptive_dt=self.adaptive_dt, **state)
+        last = time.perf_counter()
+        j = 0
+        try:
+            for j, Cj in steps:
+                if time.perf_counter() - last >= self.checkpointInterval:
+                    save(j, Cj)
+                    last = time.perf_counter()
+                yield j, Cj
+        finally:
+            steps.close()                               # Latest profile is in C.Cold once the engine is closed
+            save(j, C.Cold.get_profile())
+
+    def _continue_from(self, C:C_profiles, stored:dict, t_j:int, t:float, engine:str) -> tuple:
+        """
+            _continue_from(C, stored, t_j, t, engine)
+
+        Starts from a stored state of the same run at an earlier process time (see lumerical_on_budget).\n
+        Returns (t_j, t) of the rest of the run. Explicit engines take the remaining steps of the same t_step, so the result\n
+        is the same as the one of a run from zero. Implicit engines take the rest in steps no longer than t_step,\n
+        the adaptive engine goes on with its last step. Backward Euler start steps are not repeated.
+        """
+        C.Cold.get_profile()[:] = stored["profile"]
+        self._offset = (stored["j"], stored["t"])
+        if engine == "adaptive":
+            self.adaptive_dt = stored["adaptive_dt"]
+            return t_j, t - stored["t"]
+        if engine in ("loop", "vector"):
+            return t_j - stored["j"], t - stored["t"]
+        n = max(int(np.ceil((t - stored["t"])/self.t_step - 1e-9)), 1)
+        self.t_step = (t - stored["t"])/n
+        return n+1, t - stored["t"]
+
+    def resume(self, checkpoint:str, t:float=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> tuple:
+        """
+            resume(checkpoint, t=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Continues the run saved in a checkpoint (see lumerical_on_budget) from its last saved step to its end.\n
+        If t is longer than the process time of the run, the run is extended to t seconds (e.g. a longer t0 or t1)\n
+        without starting over. Temperature, time step and solver settings are taken from the checkpoint, so the result\n
+        is the same as the one of an uninterrupted run. Dopant and grid must match this simulation.\n
+        The checkpoint keeps being updated, so a resumed run can be resumed or extended again. Returns (C, xjunc).\n
+        A previous terminate() is cleared, so a terminated run can be resumed on the same simulation.
+
+        Parameters:
+        --------------------------------
+        checkpoint  -   Checkpoint file (.npz)                        : str
+        t           -   Process time of the whole run (seconds)       : float
+        """
+        self._terminateEvent.clear()
+        state = load_checkpoint(checkpoint)
+        if state is None:
+            progressOutput("Checkpoint could not be read.")
+            return None, 0
+        profile = state["profile"]
+        grid = state.get("x")
+        if (state["Ea"], state["D0"], state["C0"], state["x_step"]) != (self.Ea, self.D0, self.C0, self.x_step) or \
+           (self.mesh is None) != (grid is None) or (grid is not None and not np.array_equal(grid, self.mesh.x)):
+            progressOutput("Checkpoint does not match the simulation.")
+            return None, 0
+
+        self.set_temperature(state["T"], state["D"])
+        self.t_step = state["t_step"]                   # Restored to the constructor step or the limit at the end
+        self.adaptive_dt = state["adaptive_dt"]
+        j0, t0 = state["j"], state["t"]
+        t_end = state["t_end"] if t is None else max(t, state["t_end"])
+        if state["engine"] == "adaptive":
+            t_j = 1
+        else:
+            t_j = max(state["t_j"], self.time_iterations(t_end) if t is not None else 0) - j0
+        atol = None if np.isnan(state["atol"]) else state["atol"]
+
+        C = C_profiles(x_i=profile.size, Cb=state["Cb"], dtype=profile.dtype)
+        C.Cold.get_profile()[:] = profile
+        self._offset = (j0, t0)
+        try:
+            return self.lumerical_on_budget(C, state["Cb"], state["Cth"], t_j=t_j, process=state["process"], engine=state["engine"], theta=state["theta"],
+                                            t=t_end - t0 if state["engine"] == "adaptive" else (t_j-1)*self.t_step, rtol=state["rtol"], atol=atol,
+                                            checkpoint=checkpoint, progressPercentageOutput=progressPercentageOutput, progressOutput=progressOutput,
+                                            progressRateOutput=progressRateOutput)
+        finally:
+            self._offset = (0, 0.0)
+            self.t_step = self.t_step_user or self.t_step_limit
+
+    def lumerical_stream(self, C:C_profiles, Cb:float=0, Cth:float=1e15, t_j:int=1, process:bool=0, snapshot_every:float=0, engine:str="vector", theta:float=0.5, copy:bool=False, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None):
+        """
+            lumerical_stream(C, Cb=0, Cth=1e15, t_j=1, process=0, snapshot_every=0, engine="vector", theta=0.5, copy=False, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Same simulation as lumerical_on_budget, but as a generator of intermediate profiles.\n
+        Yields (t, profile, xjunc) for the initial profile, every snapshot_every seconds of process time and at the last step.\n
+        profile is a view of the engine buffer and is overwritten by the next steps, unless copy is set.\n
+        Stopping the iteration (e.g. once xjunc reaches a target) stops the simulation, C.Cold then holds the last yielded profile.
+
+        Parameters:
+        --------------------------------
+        snapshot_every  -   Process time between snapshots (seconds), 0: every step  : float
+        copy            -   Yield copies of the profiles                             : bool
+        (other parameters are the same as lumerical_on_budget, except the "adaptive" and "analytic" engines and cache,\n
+        snapshots need a fixed t_step)
+        """
+        if engine in ("adaptive", "analytic"):
+            progressOutput("Engine \"{}\" has no fixed time step, it cannot be streamed.".format(engine))
+            return
+        every = max(1, int(round(snapshot_every/self.t_step))) if snapshot_every > 0 else 1
+        tracker = JunctionTracker(Cth, self.x_step, x=None if self.mesh is None else self.mesh.x)
+        progress = ProgressReporter(t_j, progressPercentageOutput, progressRateOutput, lambda: self.terminateFlag, self.progressInterval)
+        steps = self._engine(C, Cb, t_j, process, progress, progressOutput, engine, theta)
+        if steps is None:
+            progressOutput("Engine not selected properly.")
+            return
+
+        try:
+            for j, Cj in steps:
+                if j % every == 0 or j == t_j-1:
+                    profile = Cj.copy() if copy else Cj
+                    yield float(j*self.t_step), profile, tracker.update(Cj)
+        finally:
+            steps.close()
+
+    def _engine(self, C:C_profiles, Cb:float, t_j:int, process:bool, progress:ProgressReporter, progressOutput, engine:str="vector", theta:float=0.5):
+        """
+            _engine(C, Cb, t_j, process, progress, progressOutput, engine="vector", theta=0.5)
+
+        Returns the step generator of the selected engine, None if the engine is not known.\n
+        On a mesh, coef is the (lower, upper, surface) operator of the mesh. The loop engine is for the uniform grid only.
+        """
+        if self.mesh is None:
+            coef = self.D*self.t_step/(self.x_step**2)
+        else:
+            coef = self.mesh.operator(self.D*self.t_step)
+            if C.size() != self.mesh.size():
+                progressOutput("Profile does not match the mesh.")
+                return None
+        if engine == "loop" and self.mesh is None:
+            return self._loop_engine(C, Cb, coef, t_j, process, progress, progressOutput)
+        elif engine == "vector":
+            return self._vector_engine(C, Cb, coef, t_j, process, progress, progressOutput)
+        elif engine == "implicit":
+            return self._implicit_engine(C, Cb, coef, t_j, process, progress, progressOutput, theta)
+        elif engine == "nonlinear":
+            if self.vacancy is None:
+                progressOutput("Dopant has no concentration dependent diffusivity.")
+                return None
+            return self._nonlinear_engine(C, Cb, t_j, process, progress, progressOutput, theta)
+        return None
+
+    def analytic_on_budget(self, C:C_profiles, Cb:float=0, Cth:float=1e15, t:float=0, process:bool=0) -> _C_profile:
+        """
+            analytic_on_budget(C, Cb=0, Cth=1e15, t=0, process=0)
+
+        Closed form solution for constant diffusivity on the same grid as lumerical_on_budget.\n
+        Predep. (process 0) is the constant surface concentration solution:\n
+            C(x) = Cb + (C0-Cb)*erfc(x/(2*sqrt(D*t)))\n
+        Drive-in (process 1) is the limited source Gaussian with the dose Q of the given profile (C.Cold):\n
+            C(x) = Cb + Q/sqrt(pi*D*t)*exp(-x^2/(4*D*t))\n
+        Both solutions are for a semi-infinite wafer. The Gaussian starts from a delta function at the surface,\n
+        so it is accurate once D*t of the drive-in is large compared to the one of the predep.\n
+        Junction depth is calculated analytically. Result is left in C.Cold.
+
+        Parameters:
+        --------------------------------
+        C        -   Concentration profile provided                  : C_profiles
+        Cb       -   Bottom concentration clip (atoms/cm^3)          : float
+        Cth      -   Threshold (backgrnd) concentration (atoms/cm^3) : float
+        t        -   Process time (seconds)                          : float
+        process  -   Selected process (predep./drive-in)             : bool
+        """
+        x = self.positions(C.size())
+        Dt = self.D*t
+        xjunc = 0
 
         if process == 0:
+            if Dt > 0:
+                C.Cold.get_profile()[:] = Cb + (self.C0 - Cb)*erfc(x/(2*np.sqrt(Dt)))
+                if Cb < Cth < self.C0:
+                    xjunc = 2*np.sqrt(Dt)*erfcinv((Cth - Cb)/(self.C0 - Cb))
+            else:
+                C.Cold.set_val(self.C0, 0)
+        elif process == 1:
+            Cp = C.Cold.get_profile() - Cb
+            if self.mesh is None:
+                Q = (np.sum(Cp) - 0.5*(Cp[0] + Cp[-1]))*self.x_step     # Dose (atoms/cm^2), trapezoidal rule
+            else:
+                Q = np.sum(0.5*(Cp[1:] + Cp[:-1])*self.mesh.h)
+            if Dt > 0:
+                Cs = Q/np.sqrt(np.pi*Dt)
+                C.Cold.get_profile()[:] = Cb + Cs*np.exp(-x**2/(4*Dt))
+                if Cb < Cth < Cb + Cs:
+                    xjunc = np.sqrt(4*Dt*np.log(Cs/(Cth - Cb)))
+        else:
+            print("Process not selected properly. Returning given profile.")
+
+        return C.Cold, xjunc
+
+    def _boundaries(self, Cb:float=0, process:bool=0) -> tuple:
+        """
+            _boundaries(Cb=0, process=0)
+
+        Returns the (surface, far end) concentrations of the new time step.\n
+        Predep. keeps the surface at C0. Drive-in is a limited source, its surface has no flux (None).\n
+        Far end is kept at Cb for both processes.
+        """
+        if process == 0:
+            return (self.C0, Cb)
+        return (None, Cb)
+
+    def _loop_engine(self, C:C_profiles, Cb:float, coef:float, t_j:int, process:bool, progress:ProgressReporter, progressOutput):
+        """
+            _loop_engine(C, Cb, coef, t_j, process, progress, progressOutput)
+
+        Updates the profile point by point.\n
+        Generator: yields (j, latest profile array) for the initial profile and after every step.\n
+        Result is left in C.Cold, also if the generator is closed early.
+        """
+        C_s, C_e = self._boundaries(Cb, process)
+        if process == 0:
+            C.Cold.set_val(self.C0, 0)      #set initial condition and boundary condition
+        else:
+            C.Cold.set_val(Cb, -1)          #set initial condition and boundary condition
+        yield 0, C.Cold.get_profile()
+
+        # Buffers are looked up once, the time levels are swapped locally
+        Cold = C.Cold.get_profile()
+        Cnew = C.Cnew.get_profile()
+        n = Cold.size
+        swapped = False
+        try:
             # j-1 iteration of time
             for j in range(1, t_j):
-                C.Cold.set_val(self.C0, 0) #set initial condition and boundary condition
+                if process == 0:
+                    Cold[0] = self.C0           #set initial condition and boundary condition
+                else:
+                    Cold[-1] = Cb               #set initial condition and boundary condition
                 # progressOutput(100*j/t_j, "%", "completed.", end="\r") 
-                progressPercentageOutput(int(100*j/t_j))
-                for i in range(1, C.Cold.size()-1):
-                    Cij=C.Cold.get_val(i) + coef * (C.Cold.get_val(i+1) - 2*C.Cold.get_val(i) + C.Cold.get_val(i-1))
-                    C.Cnew.set_val(Cij, i)
-                C.update_profiles(C.Cnew)
-                if self.terminateFlag:
+                if progress.update(j):
                     progressOutput("Simulation is terminated.")
                     break
-            
-            # Find junction depth
-            xjunc_idx=0
-            min_diff = float('inf')
-            for i in range(1, C.Cnew.size()-1):
-                current_diff =  abs(C.Cnew.get_val(i) - Cth)
-                if current_diff < min_diff:
-                    min_diff = current_diff
-                    xjunc_idx = i
-            xjunc = xjunc_idx*self.x_step
+                for i in range(1, n-1):
+                    Cnew[i] = Cold[i] + coef * (Cold[i+1] - 2*Cold[i] + Cold[i-1])
+                if C_s is None:
+                    Cnew[0] = Cold[0] + 2*coef * (Cold[1] - Cold[0])   # Mirror point at the surface: no flux
+                else:
+                    Cnew[0] = C_s
+                Cnew[-1] = C_e
+                Cold, Cnew = Cnew, Cold
+                swapped = not swapped
+                yield j, Cold
+        finally:
+            if swapped:
+                C.swap_profiles()
 
-        elif process == 1:
-            xjunc_idx=0
-            min_diff = float('inf')
+    def _vector_engine(self, C:C_profiles, Cb:float, coef:float, t_j:int, process:bool, progress:ProgressReporter, progressOutput):
+        """
+            _vector_engine(C, Cb, coef, t_j, process, progress, progressOutput)
+
+        Updates the whole profile at once using array slices of two preallocated buffers.\n
+        coef is D*t_step/x_step^2, or the (lower, upper, surface) operator of a mesh.\n
+        Only the active window up to the diffusion front is updated. Points ahead of it are kept at Cb in both buffers,\n
+        the window grows by one point when the first of them differs from Cb by more than frontTolerance.\n
+        Generator: yields (j, latest profile array) for the initial profile and after every step.\n
+        Result is left in C.Cold, also if the generator is closed early.
+        """
+        C_s, C_e = self._boundaries(Cb, process)
+        if process == 0:
+            C.Cold.set_val(self.C0, 0)      #set initial condition and boundary condition
+        else:
+            C.Cold.set_val(Cb, -1)          #set initial condition and boundary condition
+
+        lower, upper, surface = coef if isinstance(coef, tuple) else (coef, coef, 2*coef)
+        graded = np.ndim(lower) > 0
+        Cold = C.Cold.get_profile()
+        Cnew = C.Cnew.get_profile()
+        if graded:                                      # Coefficients in the precision of the profiles
+            lower, upper = lower.astype(Cold.dtype), upper.astype(Cold.dtype)
+        tmp = np.empty(Cold.size-2, dtype=Cold.dtype) if graded else None
+        swapped = False
+
+        # Active window: points from w on are at the background (C_e) and are not updated
+        n = Cold.size
+        tol = self.frontTolerance
+        front = np.flatnonzero(np.abs(Cold[:-1] - C_e) > tol)
+        w = max(int(front[-1])+1 if front.size else 1, 1)
+        Cold[w:] = C_e
+        Cnew[w:] = C_e
+        try:
+            yield 0, Cold
             # j-1 iteration of time
             for j in range(1, t_j):
-                C.Cold.set_val(Cb, -1) #set initial condition and boundary condition
-                # progressOutput(100*j/t_j, "%", "completed.", end="\r")     
-                progressPercentageOutput(int(100*j/t_j))
-                for i in range(1, C.size()-1):
-                    Cij=C.Cold.get_val(i) + coef * (C.Cold.get_val(i+1) - 2*C.Cold.get_val(i) + C.Cold.get_val(i-1))
-                    C.Cnew.set_val(Cij, i)
-                C.update_profiles(C.Cnew)
-                if self.terminateFlag:
+                if progress.update(j):
                     progressOutput("Simulation is terminated.")
                     break
+                # Cnew[i] = Cold[i] + coef*(Cold[i+1] - 2*Cold[i] + Cold[i-1]), written in place without temporaries
+                k = min(w, n-2)+1                                       # Points 1..k-1 are updated
+                Cin = Cnew[1:k]
+                if graded:
+                    t = tmp[:k-1]
+                    np.subtract(Cold[2:k+1], Cold[1:k], out=Cin)
+                    np.multiply(Cin, upper[:k-1], out=Cin)
+                    np.subtract(Cold[:k-1], Cold[1:k], out=t)
+                    np.multiply(t, lower[:k-1], out=t)
+                    np.add(Cin, t, out=Cin)
+                else:
+                    np.subtract(Cold[2:k+1], Cold[1:k], out=Cin)
+                    np.subtract(Cin, Cold[1:k], out=Cin)
+                    np.add(Cin, Cold[:k-1], out=Cin)
+                    np.multiply(Cin, coef, out=Cin)
+                np.add(Cin, Cold[1:k], out=Cin)
+                if w < n-1:                                             # Front reached the first background point
+                    if abs(Cnew[w] - C_e) > tol:
+                        w += 1
+                    else:
+                        Cnew[w] = C_e
+                if C_s is None:
+                    Cnew[0] = Cold[0] + surface*(Cold[1] - Cold[0])     # Mirror point at the surface: no flux
+                else:
+                    Cnew[0] = C_s
+                Cnew[-1] = C_e
+                Cold, Cnew = Cnew, Cold
+                swapped = not swapped
+                yield j, Cold
+        finally:
+            if swapped:
+                C.swap_profiles()
 
-            # Find junction depth
-            xjunc_idx=0
-            min_diff = float('inf')
-            for i in range(1, C.Cnew.size()-1):
-                current_diff =  abs(C.Cnew.get_val(i) - Cth)
-                if current_diff < min_diff:
-                    min_diff = current_diff
-                    xjunc_idx = i
-            xjunc = xjunc_idx*self.x_step
+    def _implicit_engine(self, C:C_profiles, Cb:float, coef:float, t_j:int, process:bool, progress:ProgressReporter, progressOutput, theta:float=0.5):
+        """
+            _implicit_engine(C, Cb, coef, t_j, process, progress, progressOutput, theta=0.5)
 
+        Theta method: (1 + theta*coef*L) Cnew = (1 - (1-theta)*coef*L) Cold, solved for the interior points\n
+        (and the surface point for drive-in, using a mirror point for no flux).\n
+        Crank-Nicolson rings on the initial step in the profile, so the first two steps use backward Euler.\n
+        coef is D*t_step/x_step^2, or the (lower, upper, surface) operator of a mesh.\n
+        Generator: yields (j, latest profile array) for the initial profile and after every step. Result is left in C.Cold.
+        """
+        C_s, C_e = self._boundaries(Cb, process)
+        if process == 0:
+            C.Cold.set_val(self.C0, 0)      #set initial condition and boundary condition
         else:
-            progressOutput("Process not selected properly. Returning given profile.")
+            C.Cold.set_val(Cb, -1)          #set initial condition and boundary condition
+        yield 0, C.Cold.get_profile()
 
-        Cn = C.get_profiles()[0]
-        return Cn, xjunc
+        if isinstance(coef, tuple):
+            return (yield from self._implicit_mesh_steps(C, C_s, C_e, coef, t_j, progress, progressOutput, theta))
+
+        # j-1 iteration of time
+        for j in range(1, t_j):
+            if progress.update(j):
+                progressOutput("Simulation is terminated.")
+                break
+            th = 1.0 if j + self._offset[0] <= 2 else theta
+            Cold = C.Cold.get_profile()
+            Cnew = C.Cnew.get_profile()
+            rhs = Cold[1:-1] + (1-th)*coef*(Cold[2:] - 2*Cold[1:-1] + Cold[:-2])
+            rhs[-1] += th*coef*C_e
+            if C_s is None:
+                rhs = np.concatenate(([Cold[0] + 2*(1-th)*coef*(Cold[1] - Cold[0])], rhs))
+                upper = np.full(rhs.size, -th*coef)
+                upper[0] = -2*th*coef                                 # Mirror point at the surface: no flux
+                Cnew[:-1] = solve_tridiagonal(-th*coef, 1 + 2*th*coef, upper, rhs)
+            else:
+                rhs[0] += th*coef*C_s
+                Cnew[1:-1] = solve_tridiagonal(-th*coef, 1 + 2*th*coef, -th*coef, rhs)
+                Cnew[0] = C_s
+            Cnew[-1] = C_e
+            C.swap_profiles()
+            yield j, C.Cold.get_profile()
+
+    def _implicit_mesh_steps(self, C:C_profiles, C_s:float, C_e:float, coef:tuple, t_j:int, progress:ProgressReporter, progressOutput, theta:float=0.5):
+        """
+            _implicit_mesh_steps(C, C_s, C_e, coef, t_j, progress, progressOutput, theta=0.5)
+
+        Time steps of the implicit engine on a mesh, coef is the (lower, upper, surface) operator of the mesh.
+        """
+        for j in range(1, t_j):
+            if progress.update(j):
+                progressOutput("Simulation is terminated.")
+                break
+            th = 1.0 if j + self._offset[0] <= 2 else theta
+            self._theta_solve(C.Cold.get_profile(), C.Cnew.get_profile(), C_s, C_e, coef, th)
+            C.swap_profiles()
+            yield j, C.Cold.get_profile()
+
+    def _theta_solve(self, Cold:np.array, Cnew:np.array, C_s:float, C_e:float, coef:tuple, theta:float=0.5):
+        """
+            _theta_solve(Cold, Cnew, C_s, C_e, coef, theta=0.5)
+
+        One theta method step from Cold into Cnew with the (lower, upper, surface) operator coef (see Mesh.operator).
+        """
+        lower, upper, surface = coef
+        th = theta
+        rhs = Cold[1:-1] + (1-th)*(lower*(Cold[:-2] - Cold[1:-1]) + upper*(Cold[2:] - Cold[1:-1]))
+        rhs[-1] += th*upper[-1]*C_e
+        if C_s is None:                                             # No flux at the surface: half cell
+            rhs = np.concatenate(([Cold[0] + (1-th)*surface*(Cold[1] - Cold[0])], rhs))
+            a = np.concatenate(([0], -th*lower))
+            b = np.concatenate(([1 + th*surface], 1 + th*(lower + upper)))
+            c = np.concatenate(([-th*surface], -th*upper))
+            Cnew[:-1] = solve_tridiagonal(a, b, c, rhs)
+        else:
+            rhs[0] += th*lower[0]*C_s
+            Cnew[1:-1] = solve_tridiagonal(-th*lower, 1 + th*(lower + upper), -th*upper, rhs)
+            Cnew[0] = C_s
+        Cnew[-1] = C_e
+
+    def _unit_operator(self, x_i:int=1) -> tuple:
+        """
+            _unit_operator(x_i=1)
+
+        Returns the (lower, upper, surface) operator per unit D*t_step of the grid (see Mesh.operator).
+        """
+        if self.mesh is not None:
+            return self.mesh.operator(1.0)
+        unit = np.full(x_i-2, 1/self.x_step**2)
+        return (unit, unit, 2/self.x_step**2)
+
+    def _nonlinear_engine(self, C:C_profiles, Cb:float, t_j:int, process:bool, progress:ProgressReporter, progressOutput, theta:float=0.5, rtol:float=1e-6, max_iter:int=50):
+        """
+            _nonlinear_engine(C, Cb, t_j, process, progress, progressOutput, theta=0.5, rtol=1e-6, max_iter=50)
+
+        Theta method for dC/dt = d/dx(D(C) dC/dx). D is evaluated at the points from theta-weighted old and new profiles\n
+        and averaged to the faces between them, every Picard iteration then solves one tridiagonal system with these D.\n
+        Iterations stop when the profile changes less than rtol. If they do not converge in max_iter, the step is\n
+        done as two half steps. The first two steps use backward Euler (see _implicit_engine).\n
+        Generator: yields (j, latest profile array) for the initial profile and after every step. Result is left in C.Cold.
+        """
+        C_s, C_e = self._boundaries(Cb, process)
+        if process == 0:
+            C.Cold.set_val(self.C0, 0)      #set initial condition and boundary condition
+        else:
+            C.Cold.set_val(Cb, -1)          #set initial condition and boundary condition
+        yield 0, C.Cold.get_profile()
+
+        lower, upper, surface = self._unit_operator(C.size())
+        atol = rtol*self.ni
+
+        def substep(Cold:np.array, Cnew:np.array, dt:float, th:float, depth:int=0) -> bool:
+            guess = Cold.copy()
+            for _ in range(max_iter):
+                Cm = guess if th == 1 else (1-th)*Cold + th*guess
+                Df = self.diffusivity_C(Cm)
+                Df = 0.5*(Df[1:] + Df[:-1])                                 # Diffusivity at the faces
+                op = (dt*lower*Df[:-1], dt*upper*Df[1:], dt*surface*Df[0])
+                self._theta_solve(Cold, Cnew, C_s, C_e, op, th)
+                change = np.max(np.abs(Cnew - guess)/(atol + rtol*np.abs(Cnew)))
+                guess[:] = Cnew
+                if change <= 1:
+                    return True
+            if depth >= 10:
+                return False
+            half = np.empty_like(Cold)
+            return substep(Cold, half, dt/2, th, depth+1) and substep(half, Cnew, dt/2, th, depth+1)
+
+        # j-1 iteration of time
+        warned = False
+        for j in range(1, t_j):
+            if progress.update(j):
+                progressOutput("Simulation is terminated.")
+                break
+            th = 1.0 if j + self._offset[0] <= 2 else theta
+            if not substep(C.Cold.get_profile(), C.Cnew.get_profile(), self.t_step, th) and not warned:
+                progressOutput("Nonlinear iterations did not converge, results may be inaccurate.")
+                warned = True
+            C.swap_profiles()
+            yield j, C.Cold.get_profile()
+
+    def _adaptive_engine(self, C:C_profiles, Cb:float, t:float, process:bool, progress:ProgressReporter, progressOutput, theta:float=0.5, rtol:float=1e-3, atol:float=None):
+        """
+            _adaptive_engine(C, Cb, t, process, progress, progressOutput, theta=0.5, rtol=1e-3, atol=None)
+
+        Implicit theta method with step doubling: every step is taken once with dt and twice with dt/2,\n
+        the difference estimates the local error. A step is accepted if that error is below atol + rtol*|C| at every point,\n
+        and dt is adapted to the error after every attempt. The last step is cut to land exactly on t.\n
+        The first two accepted steps use backward Euler (see _implicit_engine).\n
+        Accepted and rejected steps are counted in accepted_steps and rejected_steps.\n
+        Generator: yields (accepted steps, latest profile array) for the initial profile and after every accepted step.\n
+        Result is left in C.Cold.
+        """
+        C_s, C_e = self._boundaries(Cb, process)
+        if process == 0:
+            C.Cold.set_val(self.C0, 0)      #set initial condition and boundary condition
+        else:
+            C.Cold.set_val(Cb, -1)          #set initial condition and boundary condition
+        self.accepted_steps = self.rejected_steps = 0
+        self.adaptive_time = 0.0
+        yield 0, C.Cold.get_profile()
+        if t <= 0:
+            return
+
+        base = self._unit_operator(C.size())
+        op = lambda dt: tuple(k*self.D*dt for k in base)
+
+        Cold = C.Cold.get_profile()
+        half = np.empty_like(Cold)
+        full = np.empty_like(Cold)
+        fine = np.empty_like(Cold)
+        t_now = 0.0
+        dt = min(t, self.adaptive_dt if self._offset[0] else self.t_step_limit)    # Resumed runs go on with their last step
+        while t_now < t:
+            if progress.update(int(progress.t_j*t_now/t)):
+                progressOutput("Simulation is terminated.")
+                break
+            last = t_now + dt >= t*(1 - 1e-12)
+            if last:
+                dt = t - t_now
+            th = 1.0 if self.accepted_steps + self._offset[0] < 2 else theta
+            order = 2 if th == 0.5 else 1
+
+            self._theta_solve(Cold, full, C_s, C_e, op(dt), th)
+            self._theta_solve(Cold, half, C_s, C_e, op(dt/2), th)
+            self._theta_solve(half, fine, C_s, C_e, op(dt/2), th)
+            scale = atol + rtol*np.maximum(np.abs(fine), np.abs(Cold))
+            err = np.max(np.abs(fine - full)/scale)/(2**order - 1)
+
+            t_next = t if last else t_now + dt
+            dt *= min(5.0, max(0.2, 0.9*(max(err, 1e-10))**(-1/(order+1))))
+            self.adaptive_dt = dt
+            if err <= 1:
+                Cold[:] = fine
+                t_now = t_next
+                self.accepted_steps += 1
+                self.adaptive_time = t_now
+                yield self.accepted_steps, Cold
+            else:
+                self.rejected_steps += 1
+
+    def _run_time_step(self, t:float=0, engine:str="vector", accuracy:float=1e-4) -> float:
+        """
+            _run_time_step(t=0, engine="vector", accuracy=1e-4)
+
+        Returns the time step of a predeposition/drive_in run: the t_step given to the constructor if any,\n
+        otherwise the accuracy based step for the implicit and nonlinear engines and the stability limit for the others.
+        """
+        if self.t_step_user is not None:
+            return self.t_step_user
+        if engine in ("implicit", "nonlinear"):
+            return self.implicit_time_step(t, accuracy)
+        return self.t_step_limit
+
+    def predeposition(self, xL:float=6e-5, t0:float=0, Cb:float=0, Cth:float=1e15, engine:str="vector", accuracy:float=1e-4, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None, checkpoint:str=None) -> tuple:
+        """
+            predeposition(xL=6e-5, t0=0, Cb=0, Cth=1e15, engine="vector", accuracy=1e-4, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None, checkpoint=None)
+
+        First stage of the process: predep. of t0 seconds on a wafer of depth xL filled with Cb.\n
+        Returns (Cp_1, xjunc_1). Cp_1 can be given to any number of drive_in runs, it is not modified by them.\n
+        With a cache, the predep. of a recipe is computed once for all of its drive-in variants.\n
+        If a mesh is set, the wafer depth is the one of the mesh.\n
+        For the implicit and nonlinear engines, t_step is set from the accuracy (see implicit_time_step),\n
+        unless a t_step was given to the constructor. The step is only used for this run, t_step is restored afterwards.\n
+        For the adaptive engine, accuracy is the relative tolerance and the run ends exactly at t0.
+
+        Parameters:
+        --------------------------------
+        xL        -   Spatial length (cm)                             : float
+        t0        -   Predeposition time (seconds)                    : float
+        Cb        -   Bottom concentration clip (atoms/cm^3)          : float
+        Cth       -   Threshold (backgrnd) concentration (atoms/cm^3) : float
+        engine    -   Selected engine (see lumerical_on_budget)       : str
+        accuracy  -   Target relative error of the implicit/adaptive engine : float
+        cache     -   Result cache (numeric_cache)                    : SimulationCache
+        checkpoint -  Checkpoint file, see resume (.npz)              : str
+        """
+        x_i = int(xL/self.x_step)+1 if self.mesh is None else self.mesh.size()
+        C = C_profiles(x_i=x_i, Cb=Cb, dtype=self.dtype)
+        t_step = self.t_step                            # Step of this run only, restored for the next runs
+        self.t_step = self._run_time_step(t0, engine, accuracy)
+        try:
+            return self.lumerical_on_budget(C, Cb, Cth, t_j=self.time_iterations(t0), process=0, engine=engine, cache=cache, t=t0, rtol=accuracy, checkpoint=checkpoint,
+                                            progressPercentageOutput=progressPercentageOutput, progressOutput=progressOutput, progressRateOutput=progressRateOutput)
+        finally:
+            self.t_step = t_step
+
+    def drive_in(self, Cp_1:_C_profile=None, t1:float=0, Cb:float=0, Cth:float=1e15, engine:str="vector", accuracy:float=1e-4, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None, checkpoint:str=None) -> tuple:
+        """
+            drive_in(Cp_1, t1=0, Cb=0, Cth=1e15, engine="vector", accuracy=1e-4, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None, checkpoint=None)
+
+        Second stage of the process: drive-in of t1 seconds starting from a predep. profile (see predeposition).\n
+        Returns (Cp_2, xjunc_2). Cp_1 is copied, so the same predep. can be used for many drive-in runs.
+
+        Parameters:
+        --------------------------------
+        Cp_1      -   Predep. profile                                 : _C_profile
+        t1        -   Drive-in time (seconds)                         : float
+        (other parameters are the same as predeposition)
+        """
+        C = C_profiles(x_i=Cp_1.size(), Cb=Cb, dtype=self.dtype)
+        C.Cold = Cp_1                                   # Copied into the buffer, Cp_1 is not modified
+        t_step = self.t_step                            # Step of this run only, restored for the next runs
+        self.t_step = self._run_time_step(t1, engine, accuracy)
+        try:
+            return self.lumerical_on_budget(C, Cb, Cth, t_j=self.time_iterations(t1), process=1, engine=engine, cache=cache, t=t1, rtol=accuracy, checkpoint=checkpoint,
+                                            progressPercentageOutput=progressPercentageOutput, progressOutput=progressOutput, progressRateOutput=progressRateOutput)
+        finally:
+            self.t_step = t_step
+
+    def drive_in_budget(self, Cp_1:_C_profile=None, Dt:float=0, Cb:float=0, Cth:float=1e15, engine:str="implicit", accuracy:float=1e-4, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None) -> tuple:
+        """
+            drive_in_budget(Cp_1, Dt=0, Cb=0, Cth=1e15, engine="implicit", accuracy=1e-4, cache=None, progressPercentageOutput=print, progressOutput=print, progressRateOutput=None)
+
+        Drive-in of a whole temperature schedule, given by its thermal budget Dt (see thermal_budget).\n
+        The schedule is solved once as Dt/D seconds at the temperature of this simulation.\n
+        With the implicit (or analytic) engine, the cost does not depend on the length of the schedule.
+
+        Parameters:
+        --------------------------------
+        Dt        -   Thermal budget, integral of D dt (cm^2)         : float
+        (other parameters are the same as drive_in)
+        """
+        return self.drive_in(Cp_1, Dt/self.D, Cb, Cth, engine, accuracy, cache, progressPercentageOutput, progressOutput, progressRateOutput)
+
+    @property
+    def terminateFlag(self) -> bool:
+        return self._terminateEvent.is_set()
 
     def terminate(self):
-        self.terminateFlag = True
+        self._terminateEvent.set()
          
 
+class JunctionTarget: # Solve for process time
+    """
+        This class finds the process time at which the junction depth reaches a requested value.\n
+        The profile is integrated until xjunc crosses the target, intermediate states are kept as checkpoints.\n
+        Junction depth grows with time, so later queries bisect the checkpoints for a bracket and integrate only inside it.
+    """
+    def __init__(self, sim:N_simulation=None, Cp:_C_profile=None, Cb:float=0, Cth:float=1e15, process:bool=0, engine:str="vector", theta:float=0.5, checkpoint_every:int=200, max_checkpoints:int=256):
+        """
+        Parameters:
+        --------------------------------
+        sim               -   Simulation (dopant, temperature, time step)      : N_simulation
+        Cp                -   Initial profile (Cb for predep., Cp_1 for drive-in) : _C_profile
+        Cb                -   Bottom concentration clip (atoms/cm^3)          : float
+        Cth               -   Threshold (backgrnd) concentration (atoms/cm^3) : float
+        process           -   Selected process (predep./drive-in)             : bool
+        engine            -   Selected engine (loop/vector/implicit)          : str
+        theta             -   Implicitness (0.5: C-N, 1: B-E)                 : float
+        checkpoint_every  -   Time iterations between checkpoints             : int
+        max_checkpoints   -   Every other checkpoint is dropped above this    : int
+        """
+        self.sim = sim
+        self.Cb = Cb
+        self.Cth = Cth
+        self.process = process
+        self.engine = engine
+        self.theta = theta
+        self.checkpoint_every = checkpoint_every
+        self.max_checkpoints = max_checkpoints
+
+        # Checkpoints sorted by time: time iteration, junction depth and profile
+        Cp = Cp.get_profile() if Cp is not None else np.full(1, Cb)
+        self.j_list  = [0]
+        self.xj_list = [junction_depth(Cp, Cth, sim.x_step, x=None if sim.mesh is None else sim.mesh.x)]
+        self.C_list  = [Cp.copy()]
+
+    def solve(self, xjunc:float=0, t_max:float=86400, progressPercentageOutput=None, progressOutput=print) -> tuple:
+        """
+            solve(xjunc=0, t_max=86400, progressPercentageOutput=None, progressOutput=print)
+
+        Returns (t, profile, steps): process time at which the junction depth reaches xjunc (linear interpolation\n
+        between the two time steps around the crossing), the profile at the step after the crossing and the number\n
+        of time iterations spent for this query. Returns (None, profile, steps) if xjunc is not reached in t_max.
+
+        Parameters:
+        --------------------------------
+        xjunc     -   Target junction depth (cm)             : float
+        t_max     -   Longest process time to try (seconds)  : float
+        """
+        quiet = lambda *args, **kwargs: None
+        t_step = self.sim.t_step
+
+        # Bracket: last checkpoint before the target, the crossing is after it
+        k = max(bisect.bisect_left(self.xj_list, xjunc) - 1, 0)
+        j0 = self.j_list[k]
+        C = C_profiles(x_i=self.C_list[k].size, Cb=self.Cb)
+        C.Cold.get_profile()[:] = self.C_list[k]
+        if self.xj_list[k] >= xjunc:
+            return j0*t_step, C.Cold, 0
+
+        t_j = self.sim.time_iterations(t_max) - j0
+        t_prev, xj_prev = j0*t_step, self.xj_list[k]
+        steps = 0
+        for t, Cj, xj in self.sim.lumerical_stream(C, self.Cb, self.Cth, t_j, self.process, engine=self.engine, theta=self.theta,
+                                                    progressPercentageOutput=progressPercentageOutput or quiet, progressOutput=progressOutput):
+            j = j0 + int(round(t/t_step))
+            t = j*t_step
+            steps = j - j0
+            if j > self.j_list[-1] and j % self.checkpoint_every == 0:
+                self._checkpoint(j, xj, Cj)
+            if xj >= xjunc:
+                t_cross = t_prev + (xjunc - xj_prev)/(xj - xj_prev)*(t - t_prev) if xj > xj_prev else t
+                return t_cross, _C_profile(arr=Cj.copy()), steps       # C.Cold is only swapped in when the stream is closed
+            t_prev, xj_prev = t, xj
+        return None, C.Cold, steps
+
+    def _checkpoint(self, j:int, xj:float, Cj:np.array):
+        self.j_list.append(j)
+        self.xj_list.append(xj)
+        self.C_list.append(Cj.copy())
+        if len(self.j_list) > self.max_checkpoints:       # Keep the first one, drop every other
+            self.j_list  = self.j_list[::2]
+            self.xj_list = self.xj_list[::2]
+            self.C_list  = self.C_list[::2]
+            self.checkpoint_every *= 2
+
+
 class plot: #TESTING...
     """
         This class contains methods to plot the data.
     """
-    def __init__(self, Cp_1:_C_profile=None, Cp_2:_C_profile=None, Cth_profile:_C_profile=None, xJunc_1:float=0, xJunc_2:float=0):
+    def __init__(self, Cp_1:_C_profile=None, Cp_2:_C_profile=None, Cth:float=1e15, xJunc_1:float=0, xJunc_2:float=0):
         fig, (ax1, ax2) = plt.subplots(2)
         fig.suptitle('Concentration Profile of the Dopant')
-        # Get Cth from the Cth_profile
-        Cth = Cth_profile.arr[0]
 
         # Linear plot
         ax1.plot(0,0)
@@ -225,7 +1521,7 @@ class plot: #TESTING...
         ax1.set_ylabel('Concentration (atoms/cm^3)')
         ax1.plot(Cp_1.arr, color='blue', label='Predep.')
         ax1.plot(Cp_2.arr, color='red',  label='Drive-in')
-        ax1.plot(Cth_profile.arr, color='green', label='Background Conc.', linestyle='dashed')
+        ax1.axhline(Cth, color='green', label='Background Conc.', linestyle='dashed')
         ax1.legend(loc='upper right', prop={'size': 5})                             # Set the legend location
 
         # Logarithmic plot
@@ -236,7 +1532,7 @@ class plot: #TESTING...
         ax2.set_ylabel('Concentration (atoms/cm^3)')
         ax2.plot(Cp_1.arr, color='blue', label='Predep.')
         ax2.plot(Cp_2.arr, color='red',  label='Drive-in')
-        ax2.plot(Cth_profile.arr, color='green', label='Background Conc.', linestyle='dashed')
+        ax2.axhline(Cth, color='green', label='Background Conc.', linestyle='dashed')
         ax2.scatter(xJunc_1, Cth, color='cyan', marker='o', label='Junction Depth for Predep.')
         ax2.scatter(xJunc_2, Cth, color='magenta', marker='o', label='Junction Depth for Drive-in')
         ax2.legend(loc='upper right', prop={'size': 5})                             # Set the legend location
@@ -248,10 +1544,11 @@ class plot: #TESTING...
 
 
 def createDopantProfile(dopant_idx:int):        # DONE!
-    imp_Sb = Impurity(4.58, 3.88, 1e20)
-    imp_As = Impurity(9.17, 3.99, 2e21)
-    imp_B  = Impurity(1.0,  3.5,  3e20)
-    imp_P  = Impurity(4.7,  3.68, 1e21)
+    # Vacancy model (Fair): neutral, singly and doubly charged vacancy terms - (D0 (cm^2/s), Ea (eV), power of n/ni or p/ni)
+    imp_Sb = Impurity(4.58, 3.88, 1e20, [(0.214, 3.65, 0), (15.0, 4.08, 1)])
+    imp_As = Impurity(9.17, 3.99, 2e21, [(0.066, 3.44, 0), (12.0, 4.05, 1)])
+    imp_B  = Impurity(1.0,  3.5,  3e20, [(0.037, 3.46, 0), (0.41, 3.46, 1)], donor=False)
+    imp_P  = Impurity(4.7,  3.68, 1e21, [(3.85, 3.66, 0), (4.44, 4.00, 1), (44.2, 4.37, 2)])
 
     dopantProfile_list = [imp_Sb, imp_As, imp_B, imp_P]
     return dopantProfile_list[dopant_idx]
@@ -266,26 +1563,15 @@ def main(Cb, Cth, T0, T1, x, t0, t1):           #TESTING...
     driveIn = N_simulation(impurity, T1)
 
     # Set the simulation parameters
-    x_i  = int(x/preDep.x_step)+1    #x_step is 1e-8 cm (1 Angstrom) - constant for both simulations
-    t_j0 = int(t0/preDep.t_step)+1   #Number of time iterations for predep.
-    t_j1 = int(t1/driveIn.t_step)+1  #Number of time iterations for drive-in
-    print("# of iterations for predep.: ", t_j0, "\n# of iterations for drive-in: ", t_j1)
-
-    # Create an instance of the C_profiles class
-    C_1 = C_profiles(x_i=x_i, Cb=Cb)
-    C_2 = C_profiles(x_i=x_i, Cb=Cb)
-    Cth_profile = C_profiles().create_empty_profile(x_i, Cth)
+    print("# of iterations for predep.: ", preDep.time_iterations(t0), "\n# of iterations for drive-in: ", driveIn.time_iterations(t1))
 
     # Run the simulation
     print("Running predep simulation...")
-    Cp_1,xjunc_1 = preDep.lumerical_on_budget(C_1, Cb, Cth, t_j=t_j0)               #predep.
+    Cp_1,xjunc_1 = preDep.predeposition(x, t0, Cb, Cth)                 #predep.
     print("Junction depth for predep.: ", xjunc_1)
 
-    print("Predep simulation completed. Saving profile...")
-    C_2.Cold = Cp_1                                         #set the initial profile for the next simulation
-
     print("Running drive-in simulation...")
-    Cp_2,xjunc_2 = driveIn.lumerical_on_budget(C_2, Cb, Cth, t_j=t_j1, process=1)   #drive-in
+    Cp_2,xjunc_2 = driveIn.drive_in(Cp_1, t1, Cb, Cth)                  #drive-in
     print("Drive-in simulation completed. Saving profile...")
     print("Junction depth for drive-in: ", xjunc_2)
 
@@ -294,7 +1580,7 @@ def main(Cb, Cth, T0, T1, x, t0, t1):           #TESTING...
     Cp_2.cut_initial()
 
     # Create an instance of the plot class
-    plotter = plot(Cp_1=Cp_1, Cp_2=Cp_2, Cth_profile=Cth_profile, xJunc_1=xjunc_1, xJunc_2=xjunc_2)
+    plotter = plot(Cp_1=Cp_1, Cp_2=Cp_2, Cth=Cth, xJunc_1=xjunc_1, xJunc_2=xjunc_2)
 
     # Plot the results
     plotter.plot_all()
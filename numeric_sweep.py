@@ -0,0 +1,269 @@
+import itertools
+import threading
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+from numeric_sim import N_simulation, ProgressReporter, createDopantProfile, junction_depth
+
+
+def lumerical_on_budget_batch(C:np.array, coef:np.array, t_j:np.array, C_s:np.array, C_e:float=0, progress:ProgressReporter=None, progressOutput=print) -> np.array:
+    """
+        lumerical_on_budget_batch(C, coef, t_j, C_s, C_e=0, progress=None, progressOutput=print)
+
+    Advances many independent profiles (rows of C) with the explicit engine of N_simulation in one time loop.\n
+    Every row has its own coefficient, surface boundary and number of time iterations.\n
+    Rows stop as soon as their own t_j is reached, so every row gives the same result as a single "vector" run.
+
+    Parameters:
+    --------------------------------
+    C               -   Initial profiles, one row per case (atoms/cm^3)          : np.array (2D)
+    coef            -   D*t_step/x_step^2 of every row                           : np.array
+    t_j             -   Time iterations of every row                             : np.array
+    C_s             -   Surface concentration of every row, NaN for no flux      : np.array
+    C_e             -   Far end concentration (atoms/cm^3)                       : float
+    progress        -   Progress reporter of the batch                           : ProgressReporter
+    progressOutput  -   Function to print the progress                           : function
+    """
+    # Longest runs first, so the running rows are always the leading block of the array
+    order = np.argsort(-np.asarray(t_j), kind="stable")
+    t_j   = np.asarray(t_j)[order]
+    coef  = np.asarray(coef, dtype=float)[order].reshape(-1, 1)
+    C_s   = np.asarray(C_s, dtype=float)[order]
+    flux  = np.isnan(C_s)                               # Rows with no flux surface (drive-in)
+
+    Cold = np.array(C, dtype=float)[order]
+    Cnew = np.empty_like(Cold)
+    result = np.empty_like(Cold)
+
+    # set initial condition and boundary condition
+    Cold[~flux, 0] = C_s[~flux]
+    Cold[:, -1] = C_e
+
+    k = t_j.size
+    # j-1 iteration of time
+    for j in range(1, int(t_j.max(initial=1))):
+        if progress is not None and progress.update(j):
+            progressOutput("Simulation is terminated.")
+            break
+        k_new = int(np.count_nonzero(t_j > j))
+        if k_new < k:
+            result[k_new:k] = Cold[k_new:k]           # These rows reached their own t_j
+            k = k_new
+        A = Cold[:k]
+        B = Cnew[:k]
+        # Cnew[i] = Cold[i] + coef*(Cold[i+1] - 2*Cold[i] + Cold[i-1]), same operation order as the "vector" engine
+        Bin = B[:, 1:-1]
+        np.subtract(A[:, 2:], A[:, 1:-1], out=Bin)
+        np.subtract(Bin, A[:, 1:-1], out=Bin)
+        np.add(Bin, A[:, :-2], out=Bin)
+        np.multiply(Bin, coef[:k], out=Bin)
+        np.add(Bin, A[:, 1:-1], out=Bin)
+        B[:, 0] = np.where(flux[:k], A[:, 0] + 2*coef[:k, 0]*(A[:, 1] - A[:, 0]), C_s[:k])  # Mirror point for no flux
+        B[:, -1] = C_e
+        Cold, Cnew = Cnew, Cold
+    result[:k] = Cold[:k]
+
+    # Back to the order of the cases
+    unsorted = np.empty_like(result)
+    unsorted[order] = result
+    return unsorted
+
+
+def junction_depth_batch(C:np.array, Cth:float=1e15, x_step:float=1e-7) -> np.array:
+    """
+        junction_depth_batch(C, Cth=1e15, x_step=1e-7)
+
+    Junction depth of every row of C, same search as lumerical_on_budget (see junction_depth).
+    """
+    return np.array([junction_depth(row, Cth, x_step) for row in C])
+
+
+def _run_chunk(chunk:list, Cb:float, Cth:float, xL:float, engine:str, accuracy:float, shm_name:str=None, shape:tuple=None) -> list:
+    """
+        _run_chunk(chunk, Cb, Cth, xL, engine, accuracy, shm_name=None, shape=None)
+
+    Runs predep. and drive-in for a chunk of (index, case) pairs in a worker process.\n
+    Cases of the chunk with the same (dopant, T0, t0) share one predep. run.\n
+    Final profiles are written into the shared memory block if its name is given, only junction depths are returned.\n
+    shape is the (2, cases, x_i) shape of the block, the segment itself may be rounded up to a page.
+    """
+    quiet = lambda *args, **kwargs: None
+    outputs = {"progressPercentageOutput": quiet, "progressOutput": quiet}
+    predeps = {}
+    results = []
+    shm = None
+    for k, (dopant, T0, T1, t0, t1) in chunk:
+        impurity = createDopantProfile(dopant)
+        if (dopant, T0, t0) not in predeps:
+            preDep = N_simulation(impurity, T0, verbose=False)
+            predeps[(dopant, T0, t0)] = preDep.predeposition(xL, t0, Cb, Cth, engine, accuracy, **outputs)
+        Cp_1, xjunc_1 = predeps[(dopant, T0, t0)]
+
+        driveIn = N_simulation(impurity, T1, verbose=False)
+        Cp_2, xjunc_2 = driveIn.drive_in(Cp_1, t1, Cb, Cth, engine, accuracy, **outputs)
+
+        if shm_name is not None:
+            if shm is None:
+                shm = shared_memory.SharedMemory(name=shm_name)
+                profiles = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+            profiles[0, k] = Cp_1.get_profile()
+            profiles[1, k] = Cp_2.get_profile()
+        results.append((k, xjunc_1, xjunc_2))
+
+    if shm is not None:
+        del profiles
+        shm.close()
+    return results
+
+
+class N_sweep: # Batched simulation class
+    """
+        This class runs a grid of predep./drive-in simulations at once.\n
+        Every case is a row of one 2D array, so all cases share a single vectorized time loop.
+    """
+    def __init__(self, Cb:float=0, Cth:float=1e15, xL:float=6e-5):
+        self._terminateEvent = threading.Event()
+        self.progressInterval = 0.1                     #seconds
+        self.Cb  = Cb                                   #atoms/cm^3
+        self.Cth = Cth                                  #atoms/cm^3
+        self.xL  = xL                                   #cm
+
+    def cases(self, dopant:list=(2,), T0:list=(900,), T1:list=(900,), t0:list=(3000,), t1:list=(3000,)) -> list:
+        """
+            cases(dopant=(2,), T0=(900,), T1=(900,), t0=(3000,), t1=(3000,))
+
+        Returns every combination of the given parameters as (dopant, T0, T1, t0, t1) tuples.
+        """
+        return list(itertools.product(dopant, T0, T1, t0, t1))
+
+    def run(self, dopant:list=(2,), T0:list=(900,), T1:list=(900,), t0:list=(3000,), t1:list=(3000,), keep_profiles:bool=False, progressPercentageOutput=print, progressOutput=print) -> tuple:
+        """
+            run(dopant=(2,), T0=(900,), T1=(900,), t0=(3000,), t1=(3000,), keep_profiles=False, progressPercentageOutput=print, progressOutput=print)
+
+        Runs predep. and drive-in for every combination of the parameter lists.\n
+        Dopant indexes are the ones of createDopantProfile (0: Sb, 1: As, 2: B, 3: P).\n
+        Returns (table, profiles). table is a structured array with one row per case and the fields\n
+        dopant, T0, T1, t0, t1, xjunc_1, xjunc_2. profiles is None, or (predep., drive-in) 2D arrays if keep_profiles is set.
+
+        Parameters:
+        --------------------------------
+        dopant                   -   Dopant indexes                            : list
+        T0                       -   Temperatures for predep. (degree C)       : list
+        T1                       -   Temperatures for drive-in (degree C)      : list
+        t0                       -   Predeposition times (seconds)             : list
+        t1                       -   Drive-in times (seconds)                  : list
+        keep_profiles            -   Return the final profiles                 : bool
+        progressPercentageOutput -   Function to print the progress percentage : function
+        progressOutput           -   Function to print the progress            : function
+        """
+        cases = self.cases(dopant, T0, T1, t0, t1)
+        table = np.zeros(len(cases), dtype=[("dopant", int), ("T0", float), ("T1", float), ("t0", float), ("t1", float), ("xjunc_1", float), ("xjunc_2", float)])
+        for k, case in enumerate(cases):
+            table[k] = case + (0, 0)
+
+        # Predep. depends only on (dopant, T0, t0), it is run once for all drive-in variants
+        predeps = sorted(set((d, T, t) for d, T, _, t, _ in cases))
+        predep_idx = np.array([predeps.index((d, T, t)) for d, T, _, t, _ in cases], dtype=int)
+
+        # Time step and number of iterations of every case, same as a single N_simulation
+        preDep  = [N_simulation(createDopantProfile(d), T, verbose=False) for d, T, _ in predeps]
+        driveIn = [N_simulation(createDopantProfile(d), T, verbose=False) for d, _, T, _, _ in cases]
+        x_step = driveIn[0].x_step if cases else 1e-7
+        x_i = int(self.xL/x_step)+1
+
+        coef_0 = np.array([sim.D*sim.t_step/(sim.x_step**2) for sim in preDep])
+        coef_1 = np.array([sim.D*sim.t_step/(sim.x_step**2) for sim in driveIn])
+        t_j0 = np.array([sim.time_iterations(t) for sim, (_, _, t) in zip(preDep, predeps)], dtype=int)
+        t_j1 = np.array([sim.time_iterations(case[4]) for sim, case in zip(driveIn, cases)], dtype=int)
+        C0   = np.array([sim.C0 for sim in preDep])
+
+        # Run the simulation for predep.
+        progressOutput("Running {} predep. for {} cases...".format(len(predeps), len(cases)))
+        progress = ProgressReporter(int(t_j0.max(initial=1)), progressPercentageOutput, None, lambda: self.terminateFlag, self.progressInterval)
+        C = np.full((len(predeps), x_i), float(self.Cb))
+        Cp_1 = lumerical_on_budget_batch(C, coef_0, t_j0, C0, self.Cb, progress, progressOutput)[predep_idx]
+        table["xjunc_1"] = junction_depth_batch(Cp_1, self.Cth, x_step)
+
+        # Run the simulation for drive-in
+        progressOutput("Running drive-in of {} cases...".format(len(cases)))
+        progress = ProgressReporter(int(t_j1.max(initial=1)), progressPercentageOutput, None, lambda: self.terminateFlag, self.progressInterval)
+        Cp_2 = lumerical_on_budget_batch(Cp_1, coef_1, t_j1, np.full(len(cases), np.nan), self.Cb, progress, progressOutput)
+        table["xjunc_2"] = junction_depth_batch(Cp_2, self.Cth, x_step)
+
+        if keep_profiles:
+            return table, (Cp_1, Cp_2)
+        return table, None
+
+    def run_parallel(self, dopant:list=(2,), T0:list=(900,), T1:list=(900,), t0:list=(3000,), t1:list=(3000,), keep_profiles:bool=False, workers:int=None, chunksize:int=None, engine:str="vector", accuracy:float=1e-4, progressPercentageOutput=print, progressOutput=print) -> tuple:
+        """
+            run_parallel(dopant=(2,), T0=(900,), T1=(900,), t0=(3000,), t1=(3000,), keep_profiles=False, workers=None, chunksize=None, engine="vector", accuracy=1e-4, progressPercentageOutput=print, progressOutput=print)
+
+        Same as run, but every case is an independent N_simulation pipeline on a process pool.\n
+        Use it when the cases are too different to share one time loop (e.g. implicit engine, very different t_step).\n
+        Cases are sent to the workers in chunks, results are put back in the order of the cases.\n
+        Cases with the same predep. are kept in the same chunk, so their predep. is run once.\n
+        Profiles are returned through shared memory, they are not pickled.\n
+        Terminating cancels the chunks that are not started yet, their junction depths are left as NaN.
+
+        Parameters:
+        --------------------------------
+        workers                  -   Number of processes (default: CPU count)        : int
+        chunksize                -   Cases per task (default: ~4 tasks per process)  : int
+        engine                   -   Engine of every case (see lumerical_on_budget)  : str
+        accuracy                 -   Target relative error of the implicit engine    : float
+        (other parameters are the same as run)
+        """
+        cases = self.cases(dopant, T0, T1, t0, t1)
+        table = np.zeros(len(cases), dtype=[("dopant", int), ("T0", float), ("T1", float), ("t0", float), ("t1", float), ("xjunc_1", float), ("xjunc_2", float)])
+        for k, case in enumerate(cases):
+            table[k] = case + (np.nan, np.nan)
+
+        workers = workers or os.cpu_count() or 1
+        chunksize = chunksize or max(1, -(-len(cases)//(4*workers)))
+        indexed = sorted(enumerate(cases), key=lambda item: (item[1][0], item[1][1], item[1][3]))   # Group by (dopant, T0, t0)
+        chunks = [indexed[k:k+chunksize] for k in range(0, len(indexed), chunksize)]
+
+        # Shared block for the final profiles: (predep./drive-in, case, position)
+        shm = None
+        if keep_profiles and len(cases) > 0:
+            x_i = int(self.xL/N_simulation(createDopantProfile(cases[0][0]), cases[0][1], verbose=False).x_step)+1
+            shm = shared_memory.SharedMemory(create=True, size=2*len(cases)*x_i*8)
+
+        progressOutput("Running {} cases on {} processes...".format(len(cases), workers))
+        done = 0
+        try:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_run_chunk, chunk, self.Cb, self.Cth, self.xL, engine, accuracy, shm.name if shm is not None else None, (2, len(cases), x_i) if shm is not None else None) for chunk in chunks]
+                for future in as_completed(futures):
+                    for k, xjunc_1, xjunc_2 in future.result():
+                        table[k]["xjunc_1"] = xjunc_1
+                        table[k]["xjunc_2"] = xjunc_2
+                        done += 1
+                        progressOutput("Case {}/{} completed: {}".format(done, len(cases), cases[k]))
+                    progressPercentageOutput(int(100*done/max(len(cases), 1)))
+                    if self.terminateFlag:
+                        progressOutput("Simulation is terminated.")
+                        for f in futures:
+                            f.cancel()
+                        break
+
+            profiles = None
+            if shm is not None:
+                shared = np.ndarray((2, len(cases), x_i), dtype=np.float64, buffer=shm.buf)
+                profiles = (shared[0].copy(), shared[1].copy())
+                del shared
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+        return table, profiles
+
+    @property
+    def terminateFlag(self) -> bool:
+        return self._terminateEvent.is_set()
+
+    def terminate(self):
+        self._terminateEvent.set()